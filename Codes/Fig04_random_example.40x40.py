@@ -30,7 +30,7 @@ def main():
     X,Y= np.meshgrid(lonb,latb)
 
     ### Case1: Uniform over whole domain
-    arr0= np.zeros([nSample,ny,nx])
+    arr0= np.zeros([nSample,ny,nx],dtype=bool)
     xx= X[:-1,:-1].reshape(-1)
     yy= Y[:-1,:-1].reshape(-1)
     rg= np.random.default_rng(rg_seed)
@@ -41,7 +41,7 @@ def main():
         arr0[k,xx[:max_cells],yy[:max_cells]]=1
         
     ### Case2: Uniform over small areas (40% of x, 40% of y; two corners) 
-    arr2= np.zeros([nSample,ny,nx])
+    arr2= np.zeros([nSample,ny,nx],dtype=bool)
     rg= np.random.default_rng(rg_seed)
     for k in range(nSample):
         rg.shuffle(xx)
@@ -52,7 +52,7 @@ def main():
         arr2[k,xx[cond][:max_cells],yy[cond][:max_cells]]=1
 
     ### Case3: Gaussian over two corner areas
-    arr3= np.zeros([nSample,ny,nx])
+    arr3= np.zeros([nSample,ny,nx],dtype=bool)
     rg= np.random.default_rng(rg_seed)
     ixy1,std1= (ny*0.2,nx*0.2), 3  ## Set Center and STD 
     ixy2,std2= (ny*0.8,nx*0.8), 4  ## Set Center and STD 
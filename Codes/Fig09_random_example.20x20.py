@@ -31,7 +31,7 @@ def main():
     X,Y= np.meshgrid(lonb,latb)
 
     ### Case1: Uniform over whole domain
-    arr1= np.zeros([nSample,ny,nx])
+    arr1= np.zeros([nSample,ny,nx],dtype=bool)
     xx= X[:-1,:-1].reshape(-1)
     yy= Y[:-1,:-1].reshape(-1)
     rg= np.random.default_rng(rg_seed)
@@ -42,7 +42,7 @@ def main():
         arr1[k,xx[:max_cells],yy[:max_cells]]=1
         
     ### Case2: One Gaussian normal distribution on center of domain
-    arr2= np.zeros([nSample,ny,nx])
+    arr2= np.zeros([nSample,ny,nx],dtype=bool)
     rg= np.random.default_rng(rg_seed)
     ixy1,std1= (ny/2-0.5,nx/2-0.5), 3.2
     for k in range(nSample):
@@ -61,7 +61,7 @@ def main():
             i+=1
 
     ### Case3: Two Gaussian normal distributions on corners
-    arr3= np.zeros([nSample,ny,nx])
+    arr3= np.zeros([nSample,ny,nx],dtype=bool)
     rg= np.random.default_rng(rg_seed)
     ixy1,std1= (ny*0.25-0.5,nx*0.25-0.5), 2.
     ixy2,std2= (ny*0.75-0.5,nx*0.75-0.5), 2.4
@@ -0,0 +1,261 @@
+"""
+#
+# Batch processing of mask files: Org. metrics of every frame
+# - Input: .npy (memory-mapped), .npz, raw binary (memmap; --shape and --dtype),
+#          or NetCDF (.nc; if netCDF4 is installed), as [time, y-axis, x-axis] (or one [y,x] scene)
+# - Each file is read by time chunks, and frames of a chunk are sent to a worker pool;
+#   next chunks are read in a background thread (--prefetch) while current chunk is calculated
+# - Result of each chunk is saved as soon as it is done, and recorded in a manifest;
+#   a killed job resumes from the last chunk done when run again with the same options
+# - When all chunks of a file are done, they are merged into <out_dir>/<name>.org_metrics.npy [nt,7],
+#   where <name> is the input path relative to current directory with "__" for "/" (see out_name())
+#   (order of calc_org_metrics_module.metric_names)
+# - With --catalog, aggregate catalog (org_aggregate_catalog.py) is also saved as <name>.catalog.npz;
+#   given as input, a catalog file is recalculated without labeling (e.g., with other --metrics or --iorg_method)
+#
+# Usage: python batch_org_metrics.py masks_2020*.npy --out_dir ./org_out --chunk 500 --workers 8 --diag
+#        python batch_org_metrics.py tb_2020.nc --var Tb --threshold 241 --below --out_dir ./org_out
+#        python batch_org_metrics.py ./org_out/masks_2020.npy.catalog.npz --iorg_method exact --out_dir ./org_out2
+#
+"""
+
+import numpy as np
+import sys
+import os
+import glob
+import time
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import calc_org_metrics_module as com
+import org_aggregate_catalog as oac
+
+## Options changing the result; a manifest is valid only for the same values
+result_opts= ['diag','channel','periodic_y','metrics','iorg_method','var','threshold','below','chunk','shape','dtype',
+            'catalog','catalog_bbox','catalog_labels']
+
+def main():
+    parser= argparse.ArgumentParser(description='Batch calculation of Org. metrics with checkpoint/resume')
+    parser.add_argument('inputs',nargs='+',help='mask files (.npy, .npz, .nc, or raw binary with --shape)')
+    parser.add_argument('--out_dir',default='./org_metrics_out')
+    parser.add_argument('--var',default=None,help='variable name of .npz or NetCDF file (default: first one)')
+    parser.add_argument('--shape',type=int,nargs='+',default=None,help='[nt] ny nx of raw binary file')
+    parser.add_argument('--dtype',default='bool',help='data type of raw binary file')
+    parser.add_argument('--threshold',type=float,default=None,help='active if field>=threshold (non-zero if None)')
+    parser.add_argument('--below',action='store_true',help='active if field<=threshold')
+    parser.add_argument('--chunk',type=int,default=500,help='number of frames read and saved at once')
+    parser.add_argument('--workers',type=int,default=None,help='number of processes (serial if None)')
+    parser.add_argument('--prefetch',type=int,default=2,help='number of chunks read ahead in background (0: off)')
+    parser.add_argument('--diag',action='store_true')
+    parser.add_argument('--channel',action='store_true',help='x-axis is periodic')
+    parser.add_argument('--periodic_y',action='store_true',help='y-axis is periodic')
+    parser.add_argument('--metrics',nargs='+',default=None,choices=com.metric_names)
+    parser.add_argument('--iorg_method',default='binned',choices=['binned','exact'])
+    parser.add_argument('--mem_limit_mb',type=float,default=256,help='memory of distance tiles (MB)')
+    parser.add_argument('--spatial_index',action='store_true')
+    parser.add_argument('--backend',default='numpy',choices=['numpy','numba'])
+    parser.add_argument('--catalog',action='store_true',help='save aggregate catalog as well')
+    parser.add_argument('--catalog_bbox',action='store_true',help='add bounding box to catalog')
+    parser.add_argument('--catalog_labels',action='store_true',help='add label maps to catalog')
+    parser.add_argument('--keep_chunks',action='store_true',help='keep chunk files after merging')
+    parser.add_argument('--restart',action='store_true',help='ignore existing manifest and start over')
+    args= parser.parse_args()
+
+    os.makedirs(args.out_dir,exist_ok=True)
+    manifest= load_manifest(args)
+    files= sorted(set(fn for pattern in args.inputs for fn in (glob.glob(pattern) or [pattern])))
+
+    calc_opts= dict(diag=args.diag,channel=args.channel,periodic_y=args.periodic_y,metrics=args.metrics,
+                    iorg_method=args.iorg_method,mem_limit_mb=args.mem_limit_mb,
+                    spatial_index=args.spatial_index,backend=args.backend)
+    executor= None
+    if args.workers is not None and args.workers>1:
+        executor= ProcessPoolExecutor(max_workers=args.workers)
+    try:
+        for fn in files:
+            process_file(fn,args,manifest,calc_opts,executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return
+
+def process_file(fn,args,manifest,calc_opts,executor=None):
+    '''
+    Chunks of a file not in manifest are calculated and saved, then all chunks are merged
+    '''
+    path= os.path.abspath(fn)
+    rec= manifest['files'].get(path)
+    if rec is None:
+        rec= dict(name=out_name(path,[r['name'] for r in manifest['files'].values()]),done={})
+        manifest['files'][path]= rec
+    name= rec['name']
+    out_fn= os.path.join(args.out_dir,name+'.org_metrics.npy')
+    if rec.get('merged') and os.path.isfile(out_fn):
+        print('{}: done already'.format(name))
+        return
+    if name.endswith('.catalog.npz'):
+        ## Metrics from catalog; no labeling (connectivity and periodic axes are those of the catalog)
+        save_npy(out_fn,oac.org_indices_of_catalog(oac.load_catalog(fn),**metric_opts(calc_opts)))
+        rec['merged']= True
+        save_manifest(args.out_dir,manifest)
+        print(out_fn)
+        return
+
+    src,nt= open_masks(fn,var=args.var,shape=args.shape,dtype=args.dtype)
+    rec['nt']= nt
+    todo=[]
+    for t0 in range(0,nt,args.chunk):
+        chunk_fn= rec['done'].get(str(t0))
+        if chunk_fn is None or not all(os.path.isfile(os.path.join(args.out_dir,cfn))
+                                       for cfn in [chunk_fn]+([cat_name(chunk_fn)] if args.catalog else [])):
+            todo.append((t0,min(t0+args.chunk,nt)))
+
+    ## Next chunks are read in background while current chunk is calculated
+    chunks= ((t0,t1,read_chunk(src,t0,t1,threshold=args.threshold,below=args.below)) for t0,t1 in todo)
+    if args.prefetch>0:
+        chunks= com.prefetch(chunks,depth=args.prefetch)
+    tic= time.perf_counter()
+    for t0,t1,amap in chunks:
+        chunk_fn= '{}.t{:07d}-{:07d}.npy'.format(name,t0,t1)
+        if args.catalog:
+            cat,oids= catalog_chunk(amap,t0,args,calc_opts,executor)
+            oac.save_catalog(os.path.join(args.out_dir,cat_name(chunk_fn)),cat)
+        else:
+            oids= com.identify_aggregate_and_get_org_indices(amap,executor=executor,**calc_opts).reshape(-1,7)
+        save_npy(os.path.join(args.out_dir,chunk_fn),oids)
+        rec['done'][str(t0)]= chunk_fn
+        save_manifest(args.out_dir,manifest)  ## After chunk file, so a recorded chunk always exists
+        toc= time.perf_counter()
+        print('{}: frames {}-{} of {}, {:.1f} frames/s'.format(name,t0,t1,nt,(t1-t0)/(toc-tic)),flush=True)
+        tic= toc
+
+    chunk_fns= [os.path.join(args.out_dir,rec['done'][str(t0)]) for t0 in range(0,nt,args.chunk)]
+    save_npy(out_fn,np.concatenate([np.load(cfn) for cfn in chunk_fns]).reshape(-1,7))
+    if args.catalog:
+        cat_fns= [cat_name(cfn) for cfn in chunk_fns]
+        oac.save_catalog(os.path.join(args.out_dir,name+'.catalog.npz'),
+                         oac.concat_catalogs([oac.load_catalog(cfn) for cfn in cat_fns]))
+        chunk_fns+= cat_fns
+    rec['merged']= True
+    save_manifest(args.out_dir,manifest)
+    if not args.keep_chunks:
+        for cfn in chunk_fns:
+            os.remove(cfn)
+    print(out_fn)
+    return
+
+def out_name(path,used=()):
+    '''
+    Name of outputs of an input file: its path relative to current directory, with "__" for "/"
+        (e.g., 2020/mask.npy -> 2020__mask.npy), so same file names in different directories do not collide
+    A hash of the path is added if the name is used by another input
+    '''
+    rel= os.path.relpath(path)
+    if rel.startswith(os.pardir):
+        rel= path.lstrip(os.sep)
+    name= rel.replace(os.sep,'__')
+    if name in used:
+        name+= '.'+hashlib.sha1(path.encode()).hexdigest()[:8]
+    return name
+
+def catalog_chunk(amap,t0,args,calc_opts,executor=None):
+    '''
+    Catalog and metrics of a chunk (frames split over workers if executor is given)
+    '''
+    nt= amap.shape[0]
+    nw= 1 if executor is None else max(1,min(nt,args.workers))
+    bounds= np.linspace(0,nt,nw+1).astype(int)
+    parts= [(amap[b0:b1],t0+b0,args.catalog_bbox,args.catalog_labels,calc_opts) for b0,b1 in zip(bounds[:-1],bounds[1:])]
+    if executor is None:
+        res= [catalog_part(*part) for part in parts]
+    else:
+        res= list(executor.map(catalog_part,*zip(*parts)))
+    return oac.concat_catalogs([r[0] for r in res]), np.concatenate([r[1] for r in res])
+
+def catalog_part(amap,t0,bbox,labels,calc_opts):
+    cat= oac.build_catalog(amap,diag=calc_opts['diag'],channel=calc_opts['channel'],
+                           periodic_y=calc_opts['periodic_y'],bbox=bbox,labels=labels,
+                           backend=calc_opts['backend'],t_offset=t0)
+    return cat, oac.org_indices_of_catalog(cat,**metric_opts(calc_opts))
+
+def metric_opts(calc_opts):
+    return {k:v for k,v in calc_opts.items() if k not in ['diag','channel','periodic_y']}
+
+def cat_name(chunk_fn):
+    return chunk_fn[:-len('.npy')]+'.catalog.npz'
+
+def open_masks(fn,var=None,shape=None,dtype='bool'):
+    '''
+    Array-like of masks [nt,ny,nx] (sliced along time axis only when read), and nt
+    '''
+    ext= os.path.splitext(fn)[1].lower()
+    if ext=='.npy':
+        src= np.load(fn,mmap_mode='r')
+    elif ext=='.npz':
+        with np.load(fn) as f:
+            src= f[var if var is not None else f.files[0]]  ## Compressed, so loaded at once
+    elif ext in ['.nc','.nc4','.cdf']:
+        try:
+            import netCDF4
+        except ImportError:
+            sys.exit('netCDF4 is required to read '+fn)
+        ds= netCDF4.Dataset(fn)
+        if var is None:
+            var= [k for k,v in ds.variables.items() if v.ndim>=2][0]
+        src= ds.variables[var]
+        src.set_auto_mask(False)
+    else:
+        if shape is None:
+            sys.exit('--shape is required for raw binary file: '+fn)
+        src= np.memmap(fn,dtype=dtype,mode='r',shape=tuple(shape))
+
+    if src.ndim==2:
+        return [src], 1
+    if src.ndim!=3:
+        sys.exit('Input should be [time, y-axis, x-axis]: {} {}'.format(fn,src.shape))
+    return src, src.shape[0]
+
+def read_chunk(src,t0,t1,threshold=None,below=False):
+    '''
+    Frames t0:t1 as a bool (or as stored, if threshold is None) array [t1-t0,ny,nx]
+    '''
+    if isinstance(src,list):
+        amap= np.asarray(src[0])[np.newaxis,:,:]
+    else:
+        amap= np.asarray(src[t0:t1])
+    if threshold is not None:
+        amap= amap<=threshold if below else amap>=threshold
+    return amap
+
+def load_manifest(args):
+    '''
+    Manifest of done chunks; a new one if not found (or restart), error if options are different
+    '''
+    opts= {k:getattr(args,k) for k in result_opts}
+    fn= os.path.join(args.out_dir,'manifest.json')
+    if os.path.isfile(fn) and not args.restart:
+        with open(fn) as f:
+            manifest= json.load(f)
+        if manifest['options']!=opts:
+            sys.exit('Options differ from those of {} (use --restart to start over):\n{}\n{}'.format(
+                     fn,manifest['options'],opts))
+        return manifest
+    return dict(options=opts,files={})
+
+def save_manifest(out_dir,manifest):
+    fn= os.path.join(out_dir,'manifest.json')
+    tmp= fn+'.{}.tmp'.format(os.getpid())
+    with open(tmp,'w') as f:
+        json.dump(manifest,f,indent=1)
+    os.replace(tmp,fn)  ## Atomic, so a killed job never leaves a broken manifest
+    return
+
+def save_npy(fn,arr):
+    tmp= fn+'.{}.tmp.npy'.format(os.getpid())
+    np.save(tmp,arr)
+    os.replace(tmp,fn)
+    return
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+#
+# Benchmark of labeling and org. metrics calculation
+# - Random scenes as in Fig04/Fig09 (uniform, uniform over two corners, Gaussian over two corners)
+# - Labeling and calc_org_indexes are timed separately, for all diag/channel combinations
+# - Peak memory (tracemalloc) of each phase is recorded in a separate pass, not in the timed ones
+# - Results are saved to a JSON file for tracking regressions
+#
+# Usage: python benchmark_org_metrics.py --sizes 100 400 --densities 0.05 0.1 --nt 20 --out bench.json
+#
+"""
+
+import numpy as np
+import sys
+import os
+import time
+import json
+import platform
+import argparse
+import tracemalloc
+import calc_org_metrics_module as com
+import random_scenes_module as rsm
+
+def main():
+    parser= argparse.ArgumentParser(description='Benchmark of labeling and org. metrics')
+    parser.add_argument('--sizes',type=int,nargs='+',default=[40,100,400],help='grid size (ny=nx)')
+    parser.add_argument('--densities',type=float,nargs='+',default=[0.05,0.1],help='target density')
+    parser.add_argument('--cases',nargs='+',default=['uniform','corner','gaussian'],
+                        choices=['uniform','corner','gaussian'])
+    parser.add_argument('--nt',type=int,default=10,help='number of scenes (time steps)')
+    parser.add_argument('--repeat',type=int,default=1,help='number of repeats; minimum time is taken')
+    parser.add_argument('--mem_limit_mb',type=float,default=256,help='option for calc_org_indexes')
+    parser.add_argument('--spatial_index',action='store_true',help='option for calc_org_indexes')
+    parser.add_argument('--backend',default='numpy',choices=['numpy','numba'])
+    parser.add_argument('--seed',type=int,default=12321)
+    parser.add_argument('--out',default='./bench_org_metrics.json')
+    args= parser.parse_args()
+
+    records=[]
+    for nn in args.sizes:
+        for tgt_den in args.densities:
+            for case in args.cases:
+                arr= get_scenes(case,args.nt,nn,nn,tgt_den,args.seed)
+                for diag in [False,True]:
+                    for channel in [False,True]:
+                        rec= dict(case=case,ny=nn,nx=nn,nt=args.nt,tgt_den=tgt_den,diag=diag,channel=channel)
+                        rec.update(bench_one(arr,diag,channel,args))
+                        records.append(rec)
+                        print('{case:>8s} {ny:5d}x{nx:<5d} den={tgt_den:.3f} diag={diag:d} channel={channel:d}: '
+                              'N={n_agg_mean:8.1f}, label {t_label:8.4f}s, metrics {t_metrics:8.4f}s, '
+                              'peak {peak_mb:8.1f}MB'.format(**rec))
+
+    out= dict(meta=get_meta(args),records=records)
+    with open(args.out,'w') as f:
+        json.dump(out,f,indent=1)
+    print(args.out)
+    return
+
+def bench_one(arr,diag,channel,args):
+    '''
+    Time labeling and calc_org_indexes separately, and peak memory of each
+    '''
+    nt,ny,nx= arr.shape
+    calc_opts= dict(mem_limit_mb=args.mem_limit_mb,spatial_index=args.spatial_index,backend=args.backend)
+
+    def label():
+        return com.label_aggregates_stack(arr,diag=diag,channel=channel,return_labels=False,backend=args.backend)
+
+    def metrics(c_info,n_agg):
+        offsets= np.concatenate([[0],np.cumsum(n_agg)])
+        for t1 in range(nt):
+            com.calc_org_indexes(c_info[offsets[t1]:offsets[t1+1]],(ny,nx),channel=channel,**calc_opts)
+
+    ## Timing without tracemalloc, which slows down allocation-heavy code
+    t_label=t_metrics= np.inf
+    for _ in range(args.repeat):
+        t0= time.perf_counter()
+        _,c_info,n_agg= label()
+        t_label= min(t_label,time.perf_counter()-t0)
+        t0= time.perf_counter()
+        metrics(c_info,n_agg)
+        t_metrics= min(t_metrics,time.perf_counter()-t0)
+
+    ## Peak memory in a separate traced pass
+    tracemalloc.start()
+    _,c_info,n_agg= label()
+    peak_label= tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    base= tracemalloc.get_traced_memory()[0]
+    metrics(c_info,n_agg)
+    peak_metrics= tracemalloc.get_traced_memory()[1]-base
+    tracemalloc.stop()
+
+    return dict(n_agg_mean=float(n_agg.mean()),n_agg_max=int(n_agg.max()),
+                t_label=t_label,t_metrics=t_metrics,
+                scenes_per_sec=nt/(t_label+t_metrics),
+                peak_label_mb=peak_label/2**20,peak_metrics_mb=peak_metrics/2**20,
+                peak_mb=max(peak_label,peak_metrics)/2**20)
+
+def get_scenes(case,nt,ny,nx,tgt_den,rg_seed):
+    '''
+    Random scenes [nt,ny,nx] as in Fig04_random_example.40x40.py
+    uniform: uniform over whole domain
+    corner: uniform over two corners (40% of x, 40% of y)
+    gaussian: Gaussian over two corners
+    '''
+    max_cells= rsm.n_cells_of((ny,nx),tgt_den)
+    if case=='uniform':
+        return rsm.uniform_scenes(nt,(ny,nx),max_cells,seed=rg_seed)
+    elif case=='corner':
+        region= rsm.corner_region((ny,nx))
+        return rsm.region_uniform_scenes(nt,(ny,nx),min(max_cells,region.sum()),region,seed=rg_seed)
+    elif case=='gaussian':
+        centers= [(ny*0.2,nx*0.2),(ny*0.8,nx*0.8)]
+        stds= [3*ny/40,4*ny/40]  ## Scaled from 40x40
+        return rsm.gaussian_scenes(nt,(ny,nx),max_cells,centers,stds,counts=[max_cells//2,max_cells-max_cells//2],
+                                   seed=rg_seed)
+    else:
+        sys.exit('Case is not defined: '+case)
+
+def get_meta(args):
+    meta= dict(vars(args))
+    meta.update(time=time.strftime('%Y-%m-%dT%H:%M:%S'),python=platform.python_version(),
+                numpy=np.__version__,platform=platform.platform(),cpu_count=os.cpu_count())
+    return meta
+
+if __name__=='__main__':
+    main()
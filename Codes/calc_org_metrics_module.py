@@ -7,114 +7,989 @@ By Daeho Jin
 
 import numpy as np
 import math
+import os
+import mmap
+import time
+import contextlib
+import queue
+import threading
+from statistics import NormalDist
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def identify_aggregate_and_get_org_indices(amap0,diag=False,channel=False):
+try:
+    from scipy.spatial import cKDTree  ## Optional; only for spatial_index=True
+except ImportError:
+    cKDTree= None
+
+trapz= getattr(np,'trapezoid',None) or np.trapz  ## np.trapz is removed in NumPy 2
+
+metric_names= ['SCAI','MCAI','COP','I_org','ABCOP','N','SZ']  ## Order of output of calc_org_indexes()
+
+no_timer= contextlib.nullcontext()
+
+def phase_timer(stats,name):
+    """
+    Timer of a phase for stats (OrgMetricsStats in org_metrics_stats.py); does nothing if stats is None
+    """
+    return no_timer if stats is None else stats.phase(name)
+
+def numba_kernels(backend='numpy'):
+    """
+    Compiled kernels (calc_org_metrics_numba.py) if backend=='numba' and numba is available;
+        None otherwise, and NumPy version is used
+    """
+    if backend not in ('numpy','numba'):
+        raise ValueError('backend should be "numpy" or "numba": {}'.format(backend))
+    if backend=='numpy':
+        return None
+    try:
+        import calc_org_metrics_numba as nbk
+    except ImportError:
+        return None
+    return nbk
+
+def identify_aggregate_and_get_org_indices(amap0,diag=False,channel=False,periodic_y=False,mem_limit_mb=256,
+                                           spatial_index=False,
+                                           workers=None,executor=None,chunk_size=None,packed_nx=None,incremental=False,
+                                           cache=None,metrics=None,iorg_method='binned',stats=None,backend='numpy',
+                                           tile_size=None,pair_sampling=None):
     """
     For a given 2d or 3d array (amap0; objects are marked by True), 
         identify aggregates and 
         call the function to calculate Org. Metrics
+    amap0 can be bool (recommended), any numeric type, or a file name of .npy (memory-mapped)
+    channel: x-axis is periodic; periodic_y: y-axis is periodic (doubly periodic if both)
+    packed_nx: if given, amap0 is packed by np.packbits(amap,axis=-1) with original x-size of packed_nx
+    mem_limit_mb, spatial_index, metrics, iorg_method, pair_sampling: options for calc_org_indexes()
+    workers: number of processes; if >1, time axis is split into chunks (chunk_size) 
+             and sent to a process pool, with input in shared memory (or its memmap file)
+    executor: concurrent.futures executor to use instead of a new process pool
+    chunk_size: number of frames labeled at once; if None, all frames at once (or split for workers),
+                but for memmap or packed input, frames within label_mem_mb (see label_chunk_size())
+    incremental: if True, each frame is updated from the previous frame (in the same chunk)
+                 by relabeling only aggregates touching changed cells; 
+                 good for consecutive frames with small changes (mem_limit_mb, spatial_index are not used)
+    cache: OrgMetricsCache (org_metrics_cache.py); scenes found in cache skip labeling and metrics
+    stats: OrgMetricsStats (org_metrics_stats.py) collecting phase times, aggregates per frame, 
+           and throughput, and calling its progress callback; nothing is measured if None
+    backend: 'numpy' or 'numba' (compiled loops for labeling and pairs; same results, 
+             falls back to 'numpy' if numba is not installed; not used if incremental)
+    tile_size: (ny,nx) of tiles; if given, each frame is labeled by tiles with bounded memory 
+               (label_aggregates_tiled(); for very large grids; not with packed_nx or incremental)
     """
 
     ## Check input array
+    if isinstance(amap0,(str,os.PathLike)):
+        amap0= np.load(amap0,mmap_mode='r')
     data_dim= amap0.shape
     if len(data_dim)==2:
         amap0= amap0[np.newaxis,:,:]  ## Supposed to be [time, y-axis, x-axis]
     nt,ny,nx= amap0.shape
-    print_dt= 1000 if nt<10000 else 5000
-    
-    ## Identify aggregates
-    metrics=[] 
-    for t1 in range(nt):
-        amap= np.copy(amap0[t1,:])
-        if t1==0: print(amap.shape)
-        
-        c_info=[]
-        while amap.sum()>0:
-            cluster=[]
-            bns= np.where(amap==True)
-            init_xy= (bns[0][0],bns[1][0])
-
-            cluster.append(init_xy)
-            amap[init_xy[0],init_xy[1]]=False
-            find_neighbor(init_xy,cluster,amap,diag=diag,channel=channel)
-
-            cluster=np.asarray(cluster)
-            if channel and (cluster[:,1].max()-cluster[:,1].min())>nx/2:
-                cluster[cluster[:,1]>nx/2,1]-=nx
-            center_yx= np.mean(cluster,axis=0)
-            c_info.append((*center_yx,cluster.shape[0]))
+    if packed_nx is not None:
+        nx= packed_nx
 
-        ## Get org. metrics based on identified aggregates above
-        metrics.append(calc_org_indexes(c_info,(ny,nx),channel=channel))
-        if (t1+1)%print_dt==0:
-            print(t1+1,np.round(metrics[-1],3))
+    if chunk_size is None and (isinstance(amap0,np.memmap) or packed_nx is not None):
+        chunk_size= label_chunk_size((ny,nx))  ## Keep index arrays of labeling small for large inputs
+
+    opts= dict(diag=diag,channel=channel,periodic_y=periodic_y,packed_nx=packed_nx,incremental=incremental,cache=cache,
+               mem_limit_mb=mem_limit_mb,spatial_index=spatial_index,metrics=metrics,iorg_method=iorg_method,
+               backend=backend,tile_size=tile_size)
+    if pair_sampling is not None:
+        opts['pair_sampling']= pair_sampling  ## Approximate SCAI, MCAI, COP for very large N
+    if cache is not None and cache_key_opts(**opts) is None:
+        opts['cache']= cache= None  ## Random results are not cached
+    if (executor is not None or (workers is not None and workers>1)) and cache is not None:
+        ## Cache stays in this process: only frames not found are sent to workers
+        opts.pop('cache')
+        calc_opts= {k:v for k,v in opts.items()
+                    if k not in ['diag','channel','periodic_y','packed_nx','incremental','backend','tile_size']}
+        oids,keys,miss= cache_lookup(amap0,(ny,nx),cache,diag=diag,channel=channel,periodic_y=periodic_y,
+                                     packed_nx=packed_nx,**calc_opts)
+        if len(miss)>0:
+            oids[miss,:]= org_indices_parallel(amap0[miss],opts,workers=workers,executor=executor,
+                                               chunk_size=chunk_size,stats=stats,t_index=np.array(miss))
+            for t1 in miss:
+                cache.put(keys[t1],oids[t1,:])
+        if stats is not None:
+            for t1 in np.setdiff1d(np.arange(nt),miss):
+                stats.frame(int(t1),oids[t1,:])
+    elif executor is not None or (workers is not None and workers>1):
+        oids= org_indices_parallel(amap0,opts,workers=workers,executor=executor,
+                                   chunk_size=chunk_size,stats=stats)
+    else:
+        if chunk_size is None:
+            chunk_size= max(nt,1)
+        oids= np.empty([nt,7])
+        for t0 in range(0,nt,chunk_size):
+            t1= min(t0+chunk_size,nt)
+            oids[t0:t1,:]= org_indices_of_frames(amap0[t0:t1],stats=stats,t_offset=t0,**opts)
 
-    metrics= np.asarray(metrics)
     if nt==1:
-        metrics=metrics.squeeze()
+        oids=oids.squeeze()
+    return oids
+
+
+label_mem_mb= 256  ## Memory for labeling a chunk of frames of memmap or packed input
+label_bytes_per_cell= 100  ## Memory of labeling per active cell (indices, keys, and union-find arrays)
+
+def label_chunk_size(domain_size,mem_mb=None):
+    """
+    Number of frames labeled at once within mem_mb (label_mem_mb if None),
+        assuming all cells are active (upper bound)
+    """
+    ny,nx= domain_size
+    mem_mb= label_mem_mb if mem_mb is None else mem_mb
+    return max(1,int(mem_mb*2**20/(ny*nx*label_bytes_per_cell)))
+
+
+def iter_org_indices(scenes,diag=False,channel=False,periodic_y=False,packed_nx=None,cache=None,prefetch_depth=0,
+                     **calc_opts):
+    """
+    Streaming version of identify_aggregate_and_get_org_indices()
+    scenes: any iterable of 2d arrays [y,x] (one scene) or 3d arrays [time,y,x] (chunk of scenes)
+            (packed along x-axis by np.packbits if packed_nx is given)
+    calc_opts: options for calc_org_indexes(), e.g., metrics=['ABCOP','N'], or stats (see org_indices_of_frames())
+    Yield: float array [7] of Org. metrics for each scene, as soon as the scene (or chunk) is done
+    Only one chunk is in memory at a time, so a sequence of any length can be processed, e.g.,
+        for oid in iter_org_indices(np.load(fn,mmap_mode='r')): writer.write(oid)
+    prefetch_depth: if >0, scenes are read in a background thread up to this many ahead (see prefetch()),
+                    so reading (e.g., from disk) overlaps with labeling and metrics
+    """
+
+    if prefetch_depth>0:
+        scenes= prefetch((np.asarray(amap) for amap in scenes),depth=prefetch_depth)
+    t_offset= 0
+    for amap in scenes:
+        amap= np.asarray(amap)
+        if amap.ndim==2:
+            amap= amap[np.newaxis,:,:]
+        for oid in org_indices_of_frames(amap,diag=diag,channel=channel,periodic_y=periodic_y,packed_nx=packed_nx,
+                                         cache=cache,
+                                         t_offset=t_offset,**calc_opts):
+            yield oid
+        t_offset+= amap.shape[0]
+
+
+def prefetch(items,depth=2):
+    """
+    Iterate items in a background thread, keeping up to depth items ready ahead (bounded queue)
+    items: any iterable, e.g., a generator reading chunks from disk; it runs in the reader thread
+    The reader waits while the queue is full (back-pressure), so memory is bounded by depth items
+    An exception in the reader is raised here; the reader stops if iteration here stops early
+    """
+
+    q= queue.Queue(maxsize=max(1,depth))
+    stop= threading.Event()
+    end= object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item,timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for item in items:
+                if not put((item,None)):
+                    return
+            put((end,None))
+        except BaseException as err:
+            put((end,err))
+
+    th= threading.Thread(target=reader,name='org_metrics_prefetch',daemon=True)
+    th.start()
+    try:
+        while True:
+            item,err= q.get()
+            if err is not None:
+                raise err
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
+        th.join()
+
+
+def org_indices_of_frames(amap0,diag=False,channel=False,periodic_y=False,packed_nx=None,incremental=False,cache=None,
+                          stats=None,t_offset=0,t_index=None,backend='numpy',tile_size=None,**calc_opts):
+    """
+    Org. metrics of each frame of 3d array [time, y-axis, x-axis]
+    calc_opts: options for calc_org_indexes() (mem_limit_mb, spatial_index, metrics, iorg_method)
+    backend: 'numpy' or 'numba', for labeling and calc_org_indexes()
+    tile_size: if given, each frame is labeled by tiles (see label_aggregates_tiled())
+    stats: OrgMetricsStats; each frame is reported with its global index, t_offset+t 
+           (or t_index[t] if t_index is given)
+    Output: float array [nt,7]; see calc_org_indexes()
+    """
+
+    nt,ny,nx= amap0.shape
+    if packed_nx is not None:
+        nx= packed_nx
+    if t_index is None:
+        t_index= np.arange(t_offset,t_offset+nt)
+
+    if cache is not None and cache_key_opts(diag=diag,channel=channel,periodic_y=periodic_y,**calc_opts) is None:
+        cache= None  ## Random results are not cached
+    if cache is not None:
+        ## Only scenes not in cache are labeled and calculated
+        metrics,keys,miss= cache_lookup(amap0,(ny,nx),cache,diag=diag,channel=channel,periodic_y=periodic_y,
+                                        packed_nx=packed_nx,**calc_opts)
+        if len(miss)>0:
+            metrics[miss,:]= org_indices_of_frames(amap0[miss],diag=diag,channel=channel,periodic_y=periodic_y,
+                                                   packed_nx=packed_nx,
+                                                   incremental=incremental,stats=stats,t_index=t_index[miss],
+                                                   backend=backend,tile_size=tile_size,**calc_opts)
+            for t1 in miss:
+                cache.put(keys[t1],metrics[t1,:])
+        if stats is not None:
+            for t1 in np.setdiff1d(np.arange(nt),miss):
+                stats.frame(int(t_index[t1]),metrics[t1,:])
+        return metrics
+
+    if incremental:
+        sel= metric_plan(calc_opts.get('metrics'))[0]
+        metrics= np.empty([nt,7])
+        for t1 in range(nt):
+            amap= amap0[t1,:] if packed_nx is None else np.unpackbits(amap0[t1,:],axis=-1,count=nx)
+            tic= time.perf_counter() if stats is not None else None
+            if t1==0:
+                state= init_incremental_state(amap,diag=diag,channel=channel,periodic_y=periodic_y,
+                                              iorg_method=calc_opts.get('iorg_method','binned'))
+                metrics[t1,:]= incremental_org_indexes(state)
+            else:
+                metrics[t1,:]= update_incremental_state(state,amap)
+            metrics[t1,~sel]= np.nan
+            if stats is not None:
+                dt= time.perf_counter()-tic
+                stats.add('incremental',dt)
+                stats.frame(int(t_index[t1]),metrics[t1,:],dt)
+        return metrics
+
+    if tile_size is not None:
+        ## Identify aggregates of each frame by tiles
+        if packed_nx is not None:
+            raise ValueError('tile_size is not supported for packed input')
+        c_info= []
+        for t1 in range(nt):
+            with phase_timer(stats,'labeling'):
+                c_info.append(label_aggregates_tiled(amap0[t1],diag=diag,channel=channel,periodic_y=periodic_y,
+                                                     tile_size=tile_size)[1])
+        n_agg= np.array([ci.shape[0] for ci in c_info],dtype=int)
+        c_info= np.concatenate(c_info)
+    else:
+        ## Identify aggregates of all time steps at once
+        _,c_info,n_agg= label_aggregates_stack(amap0,diag=diag,channel=channel,periodic_y=periodic_y,
+                                               return_labels=False,packed_nx=packed_nx,stats=stats,backend=backend)
+    return org_indices_of_info(c_info,n_agg,(ny,nx),channel=channel,periodic_y=periodic_y,stats=stats,
+                               t_index=t_index,backend=backend,**calc_opts)
+
+
+def org_indices_of_info(c_info,n_agg,domain_size,channel=False,periodic_y=False,stats=None,t_index=None,
+                        backend='numpy',**calc_opts):
+    """
+    Org. metrics of each frame from identified aggregates
+    c_info: float array [M,3], sorted by frame; n_agg: int array [nt]; see label_aggregates_stack()
+    Output: float array [nt,7]; see calc_org_indexes()
+    """
+
+    nt= len(n_agg)
+    if t_index is None:
+        t_index= np.arange(nt)
+    offsets= np.concatenate([[0],np.cumsum(n_agg)]).astype(int)
+
+    metrics= np.empty([nt,7])
+    for t1 in range(nt):
+        ## Get org. metrics based on identified aggregates above
+        if stats is None:
+            metrics[t1,:]= calc_org_indexes(c_info[offsets[t1]:offsets[t1+1]],domain_size,channel=channel,
+                                            periodic_y=periodic_y,backend=backend,**calc_opts)
+        else:
+            tic= time.perf_counter()
+            metrics[t1,:]= calc_org_indexes(c_info[offsets[t1]:offsets[t1+1]],domain_size,channel=channel,
+                                            periodic_y=periodic_y,stats=stats,backend=backend,**calc_opts)
+            stats.frame(int(t_index[t1]),metrics[t1,:],time.perf_counter()-tic)
     return metrics
 
 
-def find_neighbor(ixy,clst,amap,diag=False,channel=False):
-    """ 
-    Find neighbor for 4-direction (diag==False) or 8-direction (diag=True); Recursive
-    Once found, the grid cell info is stored in clst, and marked as False
-    ixy: tuple, (iy,ix)
-    amap: an index map for a day, T/F
-    clist: xys for one group
+def org_indices_of_coords(coords,domain_size,nt=None,diag=False,channel=False,periodic_y=False,stats=None,
+                          t_offset=0,backend='numpy',**calc_opts):
+    """
+    Org. metrics of each frame from coordinates of active cells (no dense array is made)
+    coords: see label_coords()
+    Cost scales with the number of active cells, not with domain size
+    Output: float array [nt,7]; see calc_org_indexes()
     """
-    
-    ny,nx=amap.shape
-    nxys=neighbor_info(ixy,ny,nx,diag=diag,channel=channel)
-    for y1,x1 in nxys:
-        if amap[y1,x1]:
-            clst.append((y1,x1))
-            amap[y1,x1]=False
-            find_neighbor((y1,x1),clst,amap,diag=diag,channel=channel)
-    return 
 
-def neighbor_info(lxy,ny,nx,diag=False,channel=False):
+    c_info,n_agg= label_coords(coords,domain_size,nt=nt,diag=diag,channel=channel,periodic_y=periodic_y,
+                               stats=stats,backend=backend)
+    return org_indices_of_info(c_info,n_agg,domain_size,channel=channel,periodic_y=periodic_y,stats=stats,
+                               t_index=np.arange(t_offset,t_offset+n_agg.size),backend=backend,**calc_opts)
+
+
+def cache_lookup(amap0,domain_size,cache,diag=False,channel=False,periodic_y=False,packed_nx=None,**calc_opts):
     """
-    Input: co-ordinate of 1 point, (y,x)
-    Output: a list of co-ordinate which is neighboring to input. 
-    if "diag"==False: check 4-direction
-    else:           : check 8-direction including diagonal direction
+    Look up each frame of amap0 in cache
+    Output: metrics [nt,7] (found frames only), cache keys, and index of frames not found
     """
 
-    ly,lx=lxy
-    if diag:
-        tmpmap= np.ones([3,3])
+    nt= amap0.shape[0]
+    metrics= np.empty([nt,7])
+    key_opts= cache_key_opts(diag=diag,channel=channel,periodic_y=periodic_y,**calc_opts)
+    keys= [cache.key(amap0[t1,:],domain_size,packed=packed_nx is not None,**key_opts) for t1 in range(nt)]
+    miss=[]
+    for t1,key in enumerate(keys):
+        val= cache.get(key)
+        if val is None:
+            miss.append(t1)
+        else:
+            metrics[t1,:]= val
+    return metrics,keys,miss
+
+
+def cache_key_opts(diag=False,channel=False,periodic_y=False,metrics=None,iorg_method='binned',pair_sampling=None,
+                   **other_opts):
+    """
+    Options of cache key: only those changing the result, with defaults filled in,
+        so the same scene and settings have the same key from any entry point
+    Other options (mem_limit_mb, spatial_index, backend, ...) do not change the result
+    Output: dict, or None if the result is random (pair_sampling without seed) and should not be cached
+    """
+
+    key_opts= dict(diag=bool(diag),channel=bool(channel),iorg_method=iorg_method,
+                   metrics=tuple(metric_plan(metrics)[0].tolist()))
+    if periodic_y:
+        key_opts['periodic_y']= True  ## Keys of other scenes are kept as before
+    if pair_sampling is not None:
+        if pair_sampling.get('seed') is None:
+            return None
+        key_opts['pair_sampling']= tuple(sorted(pair_sampling.items()))
+    return key_opts
+
+
+def org_indices_parallel(amap0,opts,workers=None,executor=None,chunk_size=None,stats=None,t_index=None):
+    """
+    Run org_indices_of_frames() over chunks of time axis in a process pool
+    Input array is not pickled for each chunk: 
+        a memmap is re-opened from its file in workers, 
+        otherwise it is copied once to shared memory
+    Results are reassembled in the original order
+    stats: each worker collects stats of its chunk, which are merged here as chunks are done
+           (frames are reported as t_index[t] if given)
+    """
+
+    nt= amap0.shape[0]
+    if chunk_size is None:
+        nw= workers if workers is not None else (os.cpu_count() or 1)
+        chunk_size= max(1,math.ceil(nt/nw/4))
+
+    shm= None
+    if isinstance(amap0,np.memmap) and isinstance(amap0.base,mmap.mmap) and amap0.flags.c_contiguous:
+        src= dict(filename=amap0.filename,offset=amap0.offset)
     else:
-        tmpmap= np.zeros([3,3])
-        tmpmap[1,:]=1; tmpmap[:,1]=1
-    tmpmap[1,1]=0  ## Exclude Self
-    
-    if ly==0:
-        tmpmap[0,:]=0
-    elif ly==ny-1:
-        tmpmap[2,:]=0
+        shm= shared_memory.SharedMemory(create=True,size=max(1,amap0.nbytes))
+        np.ndarray(amap0.shape,dtype=amap0.dtype,buffer=shm.buf)[:]= amap0
+        src= dict(shm_name=shm.name)
+    src.update(shape=amap0.shape,dtype=amap0.dtype.str)
+
+    own_executor= executor is None
+    if own_executor:
+        executor= ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures= {}
+        for t0 in range(0,nt,chunk_size):
+            t1= min(t0+chunk_size,nt)
+            futures[executor.submit(org_indices_of_shared_chunk,src,t0,t1,opts,
+                                    stats_cls=None if stats is None else type(stats))]= t0
+
+        metrics= np.empty([nt,7])
+        for fut in as_completed(futures):
+            t0= futures[fut]
+            res= fut.result()
+            if stats is not None:
+                res,res_stats= res
+                stats.merge(res_stats,res,t_offset=t0,t_index=t_index)
+            metrics[t0:t0+res.shape[0],:]= res
+    finally:
+        if own_executor:
+            executor.shutdown()
+        if shm is not None:
+            shm.close(); shm.unlink()
+    return metrics
+
+
+def org_indices_of_shared_chunk(src,t0,t1,opts,stats_cls=None):
+    """
+    Worker of org_indices_parallel(): attach the input and process frames t0:t1
+    stats_cls: if given, stats of this chunk (frame index from 0) is returned with metrics
+    """
 
-    if not channel:
-        if lx==0:
-            tmpmap[:,0]=0
-        elif lx==nx-1:
-            tmpmap[:,2]=0
+    stats= None if stats_cls is None else stats_cls(keep_frames=True)
+    if 'shm_name' in src:
+        shm= shared_memory.SharedMemory(name=src['shm_name'])  ## Parent process unlinks it
+        amap0= np.ndarray(src['shape'],dtype=src['dtype'],buffer=shm.buf)
+        try:
+            metrics= org_indices_of_frames(amap0[t0:t1],stats=stats,**opts)
+        finally:
+            del amap0  ## Release the buffer before closing
+            shm.close()
+    else:
+        amap0= np.memmap(src['filename'],dtype=src['dtype'],mode='r',offset=src['offset'],shape=src['shape'])
+        metrics= org_indices_of_frames(amap0[t0:t1],stats=stats,**opts)
+    return metrics if stats is None else (metrics,stats)
+
+
+def label_aggregates(amap,diag=False,channel=False,periodic_y=False):
+    """
+    Label aggregates of a 2d array (amap; objects are marked by True)
+    Connectivity: 4-direction (diag==False) or 8-direction (diag=True);
+        if channel==True, x-axis is periodic (x=0 and x=nx-1 are neighbors)
+        if periodic_y==True, y-axis is periodic as well
+    Non-recursive (union-find), so cost is O(cells) and no limit on aggregate size
+
+    Output:
+        labels: int array [ny,nx]; 0 for background, 1..N for each aggregate
+        c_info: float array [N,3]; (center_y, center_x, size) of each aggregate
+    Aggregates are numbered in the order of their first grid cell (row-major)
+    """
+
+    labels,c_info,_= label_aggregates_stack(amap[np.newaxis,:,:],diag=diag,channel=channel,periodic_y=periodic_y)
+    return labels[0,:], c_info
+
+
+def label_aggregates_stack(amap0,diag=False,channel=False,periodic_y=False,return_labels=True,packed_nx=None,
+                           stats=None,backend='numpy'):
+    """
+    Label aggregates of all frames of a 3d array [time, y-axis, x-axis] in one call
+    Aggregates never connect across frames, and labels are disjoint among frames
+    packed_nx: if given, amap0 is packed along x-axis by np.packbits, and packed_nx is x-size
+    stats: OrgMetricsStats; time of labeling and centroid phases is added
+    backend: 'numpy' or 'numba'; see connect_cells()
+
+    Output:
+        labels: int array [nt,ny,nx]; 0 for background, 1..M over the whole stack
+                (None if return_labels==False)
+        c_info: float array [M,3]; (center_y, center_x, size), sorted by frame
+        n_agg: int array [nt]; number of aggregates in each frame
+    c_info of frame t is c_info[offsets[t]:offsets[t+1]], where offsets= [0, cumsum(n_agg)]
+    """
+
+    nt,ny,nx= amap0.shape
+    if packed_nx is not None:
+        nx= packed_nx
+    with phase_timer(stats,'labeling'):
+        it,iy,ix= active_cells(amap0,packed=packed_nx is not None)
+    lab,c_info,n_agg= label_cells(it,iy,ix,nt,(ny,nx),diag=diag,channel=channel,periodic_y=periodic_y,
+                                  stats=stats,backend=backend)
+
+    labels= None
+    if return_labels:
+        labels= np.zeros([nt,ny,nx],dtype=np.int32 if c_info.shape[0]<np.iinfo(np.int32).max else np.int64)
+        labels[it,iy,ix]= lab+1
+    return labels, c_info, n_agg
+
+
+def label_coords(coords,domain_size,nt=None,diag=False,channel=False,periodic_y=False,stats=None,backend='numpy'):
+    """
+    Label aggregates from coordinates of active cells
+    coords: one of
+        (it,iy,ix): COO int arrays of frame, y, and x index of active cells
+        (iy,ix): COO int arrays of a single frame
+        list of per-frame cells (ragged); each is (iy,ix) or 1d array of flat index iy*nx+ix
+    Cells may be in any order, and duplicates are ignored
+    nt: number of frames (default: last frame with active cells + 1, or length of list)
+
+    Output:
+        c_info: float array [M,3]; (center_y, center_x, size), sorted by frame
+        n_agg: int array [nt]; number of aggregates in each frame
+    """
+
+    ny,nx= domain_size
+    if isinstance(coords,list):
+        iys,ixs,its=[],[],[]
+        for t1,cc in enumerate(coords):
+            if np.ndim(cc)==1:
+                cy,cx= np.divmod(np.asarray(cc,dtype=np.int64),nx)
+            else:
+                cy,cx= (np.asarray(c,dtype=np.int64).reshape(-1) for c in cc)
+            iys.append(cy); ixs.append(cx); its.append(np.full(cy.size,t1,dtype=np.int64))
+        if nt is None:
+            nt= len(coords)
+        it,iy,ix= (np.concatenate(v) if len(v)>0 else np.zeros(0,dtype=np.int64) for v in (its,iys,ixs))
+    else:
+        coords= [np.asarray(c,dtype=np.int64).reshape(-1) for c in coords]
+        if len(coords)==2:
+            coords= [np.zeros(coords[0].size,dtype=np.int64)]+coords
+        it,iy,ix= coords
+        if nt is None:
+            nt= int(it.max())+1 if it.size>0 else 1
+    if it.size>0 and (iy.min()<0 or iy.max()>=ny or ix.min()<0 or ix.max()>=nx or it.min()<0 or it.max()>=nt):
+        raise ValueError('Coordinates out of domain [{},{},{}]'.format(nt,ny,nx))
+
+    with phase_timer(stats,'labeling'):
+        ## Sort (and remove duplicates) to row-major order, as from active_cells()
+        key= np.unique((it*ny+iy)*nx+ix)
+        it,rem= np.divmod(key,ny*nx)
+        iy,ix= np.divmod(rem,nx)
+    _,c_info,n_agg= label_cells(it,iy,ix,nt,domain_size,diag=diag,channel=channel,periodic_y=periodic_y,
+                                stats=stats,backend=backend)
+    return c_info, n_agg
+
+
+def label_thresholds(field,thresholds,above=True,diag=False,channel=False,periodic_y=False,stats=None):
+    """
+    Label aggregates of a continuous field at several thresholds in one pass
+    field: float array [ny,nx] or [nt,ny,nx]; thresholds: list of threshold values
+    above: active cells are field>=threshold if True, field<=threshold otherwise (e.g., brightness temperature)
+
+    Aggregates are nested across thresholds (component tree), so cells and their neighbor pairs are found
+        only once at the loosest threshold; going from the strictest threshold, each level only merges
+        components by edges newly activated at that level
+    Roots remain the first cell of each aggregate, so each table is the same as labeling field>=threshold
+
+    Output: list (order of thresholds) of (c_info, n_agg); see label_aggregates_stack()
+    """
+
+    field= np.asarray(field)
+    if field.ndim==2:
+        field= field[np.newaxis,:]
+    nt,ny,nx= field.shape
+    thr= np.asarray(thresholds,dtype=float).reshape(-1)
+    if not above:
+        field,thr= -np.asarray(field,dtype=float),-thr  ## Float first; negating unsigned ints wraps around
+    K= thr.size
+    order= np.argsort(-thr,kind='stable')  ## Strictest first
+    thr_asc= np.sort(thr)
+    out= [None]*K
+    if K==0:
+        return out
+
+    with phase_timer(stats,'labeling'):
+        it,iy,ix= np.nonzero(field>=thr_asc[0])
+        ## Level of each cell: index (strictest first) of first threshold the cell passes
+        lev= K-np.searchsorted(thr_asc,field[it,iy,ix],side='right')
+        key= (it.astype(np.int64)*ny+iy)*nx+ix
+        src,dst= neighbor_pairs(key,iy,ix,(ny,nx),diag=diag,channel=channel,periodic_y=periodic_y,
+                                t_key=it.astype(np.int64)*(ny*nx))
+        e_lev= np.maximum(lev[src],lev[dst])
+        e_ord= np.argsort(e_lev,kind='stable')
+        e_bnd= np.searchsorted(e_lev[e_ord],np.arange(K+1))
+    n= key.size
+    root= np.arange(n)
+    rank= np.zeros(n,dtype=np.int64)
+    for k in range(K):
+        with phase_timer(stats,'labeling'):
+            ee= e_ord[e_bnd[k]:e_bnd[k+1]]
+            if ee.size>0:
+                ## Union-find over current components touched by new edges only
+                ra,rb= root[src[ee]], root[dst[ee]]
+                nodes,inv= np.unique(np.concatenate([ra,rb]),return_inverse=True)
+                nr= union_find(nodes.size,inv[:ee.size],inv[ee.size:])
+                lut= np.arange(n)
+                lut[nodes]= nodes[nr]
+                root= lut[root]
+            idx= np.nonzero(lev<=k)[0]
+            ri= root[idx]
+            roots= idx[ri==idx]  ## In row-major order
+            rank[roots]= np.arange(roots.size)
+            lab= rank[ri]
+            n_agg= np.bincount(it[roots],minlength=nt)
+        with phase_timer(stats,'centroid'):
+            c_info= aggregate_info(lab,roots.size,iy[idx],ix[idx],(ny,nx),channel=channel,
+                                   periodic_y=periodic_y)
+        out[order[k]]= (c_info,n_agg)
+    return out
+
+
+def org_indices_of_thresholds(field,thresholds,above=True,diag=False,channel=False,periodic_y=False,
+                              return_info=False,stats=None,backend='numpy',**calc_opts):
+    """
+    Org. metrics of a continuous field at several thresholds, labeled once (see label_thresholds())
+    calc_opts: options for calc_org_indexes() (mem_limit_mb, spatial_index, metrics, iorg_method)
+    Output: float array [K,7] for 2d field, [K,nt,7] for 3d field (K: number of thresholds)
+            and list of (c_info, n_agg) if return_info
+    """
+
+    field= np.asarray(field)
+    domain_size= field.shape[-2:]
+    info= label_thresholds(field,thresholds,above=above,diag=diag,channel=channel,periodic_y=periodic_y,stats=stats)
+    metrics= np.stack([org_indices_of_info(c_info,n_agg,domain_size,channel=channel,periodic_y=periodic_y,
+                                           stats=stats,backend=backend,**calc_opts) for c_info,n_agg in info])
+    metrics= metrics.reshape(len(info),*field.shape[:-2],7)
+    if return_info:
+        return metrics, info
+    return metrics
+
+
+def label_cells(it,iy,ix,nt,domain_size,diag=False,channel=False,periodic_y=False,stats=None,backend='numpy'):
+    """
+    Label active cells (it,iy,ix) in row-major order (as from active_cells())
+    Output: lab [n] (0..M-1, sorted by frame), c_info [M,3], n_agg [nt]; see label_aggregates_stack()
+    """
+
+    with phase_timer(stats,'labeling'):
+        root= connect_cells(iy,ix,domain_size,diag=diag,channel=channel,periodic_y=periodic_y,it=it,backend=backend)
+
+        ## Root is the first cell of each aggregate, so ranks of roots keep row-major order
+        is_root= root==np.arange(root.size)
+        lab= (np.cumsum(is_root)-1)[root]
+        M= int(is_root.sum())
+        n_agg= np.bincount(it[is_root],minlength=nt)
+    with phase_timer(stats,'centroid'):
+        c_info= aggregate_info(lab,M,iy,ix,domain_size,channel=channel,periodic_y=periodic_y)
+    return lab, c_info, n_agg
+
+
+def label_aggregates_tiled(amap,diag=False,channel=False,periodic_y=False,tile_size=(1024,1024),workers=None,
+                           executor=None,labels_out=None):
+    """
+    Label aggregates of a large 2d array (amap; e.g., np.memmap) tile by tile
+    Tiles are labeled independently (in a process pool if workers>1 or executor is given),
+        then aggregates are merged across tile seams (including periodic seams)
+    Memory is bounded by tile size, plus boundary lines and per-aggregate sums
+    labels_out: int array [ny,nx] (e.g., np.memmap) to write labels into; no labels if None
+
+    Output: labels_out, c_info; same as label_aggregates() (c_info in the same order)
+    """
+
+    ny,nx= amap.shape
+    th,tw= tile_size
+    ys,xs= list(range(0,ny,th)), list(range(0,nx,tw))
+    tiles= [(y0,min(y0+th,ny),x0,min(x0+tw,nx)) for y0 in ys for x0 in xs]
+    periodic= (periodic_y,channel)
+
+    ## 1. Components of each tile, with sums and node ids on tile boundary lines
+    own_executor= executor is None and workers is not None and workers>1
+    if own_executor:
+        executor= ProcessPoolExecutor(max_workers=workers)
+    try:
+        res= []
+        if executor is None:
+            for y0,y1,x0,x1 in tiles:
+                res.append(label_tile(amap[y0:y1,x0:x1],y0,x0,(ny,nx),diag,periodic,labels_out is not None))
+        else:
+            ## Only a few tiles in flight, so input is not copied at once
+            nflight= 2*(workers or os.cpu_count() or 1)
+            futures= []
+            for k,(y0,y1,x0,x1) in enumerate(tiles):
+                futures.append(executor.submit(label_tile,np.asarray(amap[y0:y1,x0:x1]),y0,x0,(ny,nx),diag,
+                                               periodic,labels_out is not None))
+                if k>=nflight:
+                    res.append(futures[k-nflight].result())
+            res+= [fut.result() for fut in futures[len(res):]]
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    offsets= np.concatenate([[0],np.cumsum([r['n'] for r in res])])
+    n_node= int(offsets[-1])
+    for r,off,(y0,y1,x0,x1) in zip(res,offsets,tiles):
+        for key in ['top','bottom','left','right']:
+            r[key]= np.where(r[key]>=0,r[key]+off,-1)
+        if labels_out is not None:
+            labels_out[y0:y1,x0:x1]= np.where(r['labels']>0,r['labels']+off,0)
+            del r['labels']
+
+    ## 2. Merge nodes across seams: full lines along y (between tile rows) and along x (between tile columns)
+    nc= len(xs)
+    src,dst= [],[]
+    for ir in range(len(ys)):
+        if ir+1<len(ys) or periodic_y:
+            bottom= np.concatenate([res[ir*nc+ic]['bottom'] for ic in range(nc)])
+            top= np.concatenate([res[(ir+1)%len(ys)*nc+ic]['top'] for ic in range(nc)])
+            src,dst= join_lines(bottom,top,diag,channel,src,dst)
+    for ic in range(nc):
+        if ic+1<nc or channel:
+            right= np.concatenate([res[ir*nc+ic]['right'] for ir in range(len(ys))])
+            left= np.concatenate([res[ir*nc+(ic+1)%nc]['left'] for ir in range(len(ys))])
+            src,dst= join_lines(right,left,diag,periodic_y,src,dst)
+    root= union_find(n_node,np.concatenate(src+[np.zeros(0,dtype=int)]),np.concatenate(dst+[np.zeros(0,dtype=int)]))
+
+    ## 3. Aggregates in order of their first cell (row-major), as single-pass labeling
+    is_root= root==np.arange(n_node)
+    first= np.full(n_node,ny*nx)
+    np.minimum.at(first,root,np.concatenate([r['first'] for r in res]))
+    order= np.argsort(first[is_root],kind='stable')
+    rank= np.empty(order.size,dtype=int)
+    rank[order]= np.arange(order.size)
+    lab= rank[(np.cumsum(is_root)-1)[root]]  ## Final aggregate index of each node
+    M= order.size
+
+    size= np.bincount(lab,weights=np.concatenate([r['size'] for r in res]),minlength=M)
+    c_info= np.empty([M,3],dtype=float)
+    c_info[:,2]= size
+    for k,n in enumerate((ny,nx)):
+        ssum= np.bincount(lab,weights=np.concatenate([r['sum'][:,k] for r in res]),minlength=M)
+        if periodic[k] and M>0:
+            ## Unwrap around circular mean of each aggregate, as periodic_mean()
+            ref= circular_ref(np.bincount(lab,weights=np.concatenate([r['sin'][:,k] for r in res]),minlength=M),
+                              np.bincount(lab,weights=np.concatenate([r['cos'][:,k] for r in res]),minlength=M),
+                              size,n)
+            cmin,cmax= [np.concatenate([r[key][:,k] for r in res]) for key in ['min','max']]
+            kmin,kmax= np.round((cmin-ref[lab])/n), np.round((cmax-ref[lab])/n)
+            nsz= np.concatenate([r['size'] for r in res])
+            shift= kmin*nsz
+            ## Nodes with cells on both sides of the cut: shift of each cell from the tile again
+            for it in np.unique(np.searchsorted(offsets,np.nonzero(kmin!=kmax)[0],side='right')-1):
+                y0,y1,x0,x1= tiles[it]
+                tl,iy,ix= tile_cells(amap[y0:y1,x0:x1],diag,periodic)
+                ii= (iy+y0,ix+x0)[k]
+                node= tl+offsets[it]
+                nodes= np.arange(offsets[it],offsets[it+1])
+                shift[nodes]= np.bincount(tl,weights=np.round((ii-ref[lab[node]])/n),minlength=nodes.size)
+            cc= np.mod((ssum-n*np.bincount(lab,weights=shift,minlength=M))/size,n)
+            c_info[:,k]= np.where(cc>=n,cc-n,cc)
+        else:
+            c_info[:,k]= ssum/np.maximum(size,1)
+
+    if labels_out is not None:
+        lut= np.concatenate([[0],lab+1]).astype(labels_out.dtype)
+        for y0,y1,x0,x1 in tiles:
+            labels_out[y0:y1,x0:x1]= lut[labels_out[y0:y1,x0:x1]]
+    return labels_out, c_info
+
+
+def tile_cells(tile,diag=False,periodic=(False,False)):
+    """
+    Active cells (iy,ix) of a tile, and their component index (0..M-1) within the tile
+    Tiles are not periodic by themselves; periodic seams are merged in label_aggregates_tiled()
+    """
+
+    iy,ix= np.nonzero(tile)
+    root= connect_cells(iy,ix,tile.shape,diag=diag)
+    is_root= root==np.arange(root.size)
+    return (np.cumsum(is_root)-1)[root], iy, ix
+
+
+def label_tile(tile,y0,x0,domain_size,diag=False,periodic=(False,False),return_labels=False):
+    """
+    Worker of label_aggregates_tiled(): components of a tile at (y0,x0)
+    Output: dict of number of components (n), and of each component, 
+            size, sum of (y,x), flat index of the first cell, and for periodic axes sin, cos, min, max;
+            component index on the tile boundary lines (top, bottom, left, right; -1 for empty),
+            and labels of the tile (1..n) if return_labels
+    """
+
+    ny,nx= domain_size
+    tile= np.asarray(tile)
+    lab,iy,ix= tile_cells(tile,diag,periodic)
+    M= int(lab.max())+1 if lab.size>0 else 0
+    gy,gx= iy+y0, ix+x0
+    out= dict(n=M,size=np.bincount(lab,minlength=M).astype(float))
+    out['sum']= np.stack([np.bincount(lab,weights=gy,minlength=M),np.bincount(lab,weights=gx,minlength=M)],axis=1)
+    out['first']= np.full(M,ny*nx)
+    np.minimum.at(out['first'],lab,gy*nx+gx)
+    out['sin'],out['cos']= np.zeros([M,2]),np.zeros([M,2])
+    out['min'],out['max']= np.zeros([M,2]),np.zeros([M,2])
+    for k,(gg,n) in enumerate([(gy,ny),(gx,nx)]):
+        if periodic[k]:
+            th= gg*(2*math.pi/n)
+            out['sin'][:,k]= np.bincount(lab,weights=np.sin(th),minlength=M)
+            out['cos'][:,k]= np.bincount(lab,weights=np.cos(th),minlength=M)
+            out['min'][:,k]= n; out['max'][:,k]= -1
+            np.minimum.at(out['min'][:,k],lab,gg); np.maximum.at(out['max'][:,k],lab,gg)
+
+    labels= np.zeros(tile.shape,dtype=np.int64)
+    labels[iy,ix]= lab+1
+    out.update(top=labels[0,:]-1,bottom=labels[-1,:]-1,left=labels[:,0]-1,right=labels[:,-1]-1)
+    if return_labels:
+        out['labels']= labels
+    return out
+
+
+def join_lines(a,b,diag=False,periodic=False,src=None,dst=None):
+    """
+    Edges between nodes on two adjacent lines of cells (a, b; node id or -1 for empty)
+    Same position, and +-1 along the line if diag (wrapped around if the line is periodic)
+    """
+
+    src= [] if src is None else src
+    dst= [] if dst is None else dst
+    n= a.size
+    for d in ([0,1,-1] if diag else [0]):
+        p= np.arange(n); q= p+d
+        if periodic:
+            q%= n
+        else:
+            ok= (q>=0) & (q<n)
+            p,q= p[ok],q[ok]
+        ok= (a[p]>=0) & (b[q]>=0)
+        src.append(a[p[ok]]); dst.append(b[q[ok]])
+    return src,dst
+
+
+def active_cells(amap0,packed=False):
+    """
+    Coordinates (it,iy,ix) of active cells of 3d array, in row-major order
+    No float copy of the array is made; if packed (np.packbits along x-axis), 
+        only non-zero bytes are unpacked
+    """
+
+    if not packed:
+        return np.nonzero(amap0)
+
+    it,iy,ib= np.nonzero(amap0)
+    kk,bb= np.nonzero(np.unpackbits(np.asarray(amap0[it,iy,ib],dtype=np.uint8)[:,np.newaxis],axis=1))
+    return it[kk], iy[kk], ib[kk]*8+bb
+
+
+def connect_cells(iy,ix,domain_size,diag=False,channel=False,periodic_y=False,it=None,backend='numpy'):
+    """
+    iy, ix: coordinates of active grid cells, sorted in row-major order (as from np.nonzero)
+    it: frame index of each cell (optional); cells of different frames are never connected
+    backend: 'numpy' (vectorized edges and union-find) or 'numba' (one compiled loop over cells)
+    Output: index of root cell for each cell; 
+        root is the first cell (in row-major order) of the aggregate the cell belongs to
+    """
+
+    ny,nx= domain_size
+    key= iy.astype(np.int64)*nx+ix
+    if it is not None:
+        t_key= it.astype(np.int64)*(ny*nx)
+        key+= t_key
+    n= key.size
+    if n==0:
+        return np.zeros(0,dtype=np.int64)
+    nbk= numba_kernels(backend)
+    if nbk is not None:
+        return nbk.connect_cells_nb(key,iy.astype(np.int64),ix.astype(np.int64),ny,nx,diag,channel,periodic_y,
+                                    t_key if it is not None else np.zeros(n,dtype=np.int64))
+
+    return union_find(n,*neighbor_pairs(key,iy,ix,domain_size,diag=diag,channel=channel,periodic_y=periodic_y,
+                                        t_key=t_key if it is not None else None))
+
+
+def neighbor_pairs(key,iy,ix,domain_size,diag=False,channel=False,periodic_y=False,t_key=None):
+    """
+    Pairs of adjacent active cells, found by sorted-neighbor joins of cell keys
+    key: sorted cell keys (iy*nx+ix, plus t_key for frame); see connect_cells()
+    Output: src, dst; index of cells connected (forward neighbors only)
+    """
+
+    ny,nx= domain_size
+    n= key.size
+    ## Only forward neighbors are needed since connection is symmetric
+    offsets= [(0,1),(1,0)]
+    if diag:
+        offsets+= [(1,1),(1,-1)]
+
+    src,dst= [],[]
+    for dy,dx in offsets:
+        y1,x1= iy+dy, ix+dx
+        if periodic_y:
+            y1= y1%ny
+        if channel:
+            x1= x1%nx
+            ok= y1<ny
+        else:
+            ok= (y1<ny) & (x1>=0) & (x1<nx)
+        idx0= np.nonzero(ok)[0]
+        nkey= y1[idx0].astype(np.int64)*nx+x1[idx0]
+        if t_key is not None:
+            nkey+= t_key[idx0]
+        loc= np.minimum(np.searchsorted(key,nkey),n-1)
+        hit= key[loc]==nkey
+        src.append(idx0[hit]); dst.append(loc[hit])
+    return np.concatenate(src), np.concatenate(dst)
+
+
+def union_find(n,src,dst):
+    """
+    Vectorized union-find for n nodes connected by edges (src[k], dst[k])
+    Output: root index for each node; root is the smallest node index of each group
+    """
 
-    tmplist=np.where(tmpmap==1)
-    nlist=[]
-    for ty,tx in zip(*tmplist):
-        x1= tx+lx-1
-        if x1>=nx: x1-=nx
-        nlist.append((ty+ly-1,x1))
+    parent= np.arange(n)
+    while src.size>0:
+        ra,rb= parent[src], parent[dst]
+        live= ra!=rb
+        if not live.any():
+            break
+        src,dst,ra,rb= src[live],dst[live],ra[live],rb[live]
 
-    return nlist
+        ## Hook larger root to smaller root, then compress paths to the root
+        np.minimum.at(parent,np.maximum(ra,rb),np.minimum(ra,rb))
+        while True:
+            gp= parent[parent]
+            if np.array_equal(gp,parent):
+                break
+            parent= gp
+    return parent
 
 
-def calc_org_indexes(c_info,domain_size,channel=False):
+def aggregate_info(lab,N,iy,ix,domain_size,channel=False,periodic_y=False):
+    """
+    lab: aggregate index (0..N-1) of each grid cell at (iy,ix)
+    Output: float array [N,3]; (center_y, center_x, size) of each aggregate
+    Center on periodic axis is in [0,n); see periodic_mean()
+    """
+
+    ny,nx= domain_size
+    size= np.bincount(lab,minlength=N).astype(float)
+    c_info= np.empty([N,3],dtype=float)
+    for k,(ii,n,periodic) in enumerate([(iy,ny,periodic_y),(ix,nx,channel)]):
+        if periodic and N>0:
+            c_info[:,k]= periodic_mean(lab,N,ii,n,size)
+        else:
+            c_info[:,k]= np.bincount(lab,weights=ii,minlength=N)/size
+    c_info[:,2]= size
+    return c_info
+
+
+def periodic_mean(lab,N,ii,n,size):
+    """
+    Mean of periodic coordinate (ii; period n) of each aggregate
+    Cells are unwrapped around the circular mean of their aggregate (within +-n/2), 
+        so aggregates crossing the boundary are continuous, and then averaged
+    """
+
+    th= ii*(2*math.pi/n)
+    ref= circular_ref(np.bincount(lab,weights=np.sin(th),minlength=N),
+                      np.bincount(lab,weights=np.cos(th),minlength=N),size,n)
+    xu= ii-n*np.round((ii-ref[lab])/n)  ## Shift by whole periods, so the mean is exact if not crossing
+    cc= np.mod(np.bincount(lab,weights=xu,minlength=N)/size,n)
+    return np.where(cc>=n,cc-n,cc)
+
+
+def circular_ref(ssin,scos,size,n):
+    """
+    Circular mean (period n) from sums of sin and cos of each aggregate
+    Mean sin and cos are rounded (1.e-9), so the result does not depend on the order of summation
+        (e.g., by tiles); 0 if undefined (e.g., a ring around the domain)
+    """
+
+    ## +0. turns -0. into 0., since arctan2(0.,-0.) is pi
+    return np.arctan2(np.round(ssin/size,9)+0.,np.round(scos/size,9)+0.)*(n/2/math.pi)
+
+
+def calc_org_indexes(c_info,domain_size,channel=False,periodic_y=False,mem_limit_mb=256,spatial_index=False,
+                     metrics=None,iorg_method='binned',stats=None,backend='numpy',pair_sampling=None):
     '''
     c_info: list cotains aggregate info, (center_y, center_x, size)
     L_gridcells: characteristic length in terms of number of grid cells
     domain_size: [ny,nx]
+    channel, periodic_y: x-axis, y-axis is periodic; distance is minimum image on periodic axes
+    mem_limit_mb: distance matrix is processed by tiles of rows within this memory (MB), 
+                  and full matrix is never built; None for all rows at once (no limit)
+    spatial_index: if True, nearest neighbor (Iorg) and ABCOP are searched by KD-tree 
+                   in O(N log N) (needs scipy; otherwise ignored)
+    metrics: list of metric names to calculate (see metric_names); all if None
+             Others are returned as NaN, and work only for them is skipped
+             (e.g., no distance calculation at all for ['N','SZ'])
+    iorg_method: 'binned' (histogram of nearest neighbor distance with 0.1 bins, as in the paper)
+                 or 'exact' (empirical CDF integrated analytically; no bins, independent of domain size)
+    stats: OrgMetricsStats; time of distance, pair_sums, abcop, and iorg phases is added
+    backend: 'numpy' (tiles of distance matrix) or 'numba' (compiled loop over pairs with O(N) memory; 
+             mem_limit_mb is not needed, and its time is added to pair_sums phase in stats)
+    pair_sampling: if given (dict of options for sample_pair_sums(), e.g., dict(rel_tol=0.01,time_budget=0.5)),
+                   SCAI, MCAI, and COP are estimated from a stratified sample of pairs instead of all pairs
+                   (for very large N; use with spatial_index=True, or ABCOP and Iorg still need all pairs)
+                   Use approx_pair_indexes() for the confidence interval
 
     Calculate SCAI, MCAI, COP, Iorg, ABCOP
     ABCOP min_crt of d2=1
@@ -126,85 +1001,707 @@ def calc_org_indexes(c_info,domain_size,channel=False):
     ny,nx=domain_size
     A_domain= nx*ny
     L_domain= math.sqrt(A_domain) # Length of domain
-    r_domain= math.sqrt(A_domain/math.pi) # nominal radius of domain
 
-    ci = np.asarray(c_info)
+    ci = np.array(c_info,dtype=float).reshape([-1,3])
     
     N = ci.shape[0]  # Total number of aggregates
+    abcop_crt=1
+    sums=V2max=nnd= None
+    sel,plan= metric_plan(metrics)
+
+    if N>=2 and (plan['pairs'] or plan['abcop'] or plan['nearest']):
+        rr = np.sqrt(ci[:,-1]/math.pi)  # Estimated radius
+
+        cyx= ci[:,:2]
+        period= domain_period(domain_size,channel=channel,periodic_y=periodic_y)
+
+        ### Rows of distance matrix per tile; all rows at once if no memory limit
+        nb= N if mem_limit_mb is None else max(1,min(N,int(mem_limit_mb*2**20/(N*8*tile_nbuf))))
+
+        ### For all pairs and for each aggregate, streaming tiles of distance matrix
+        use_tree= spatial_index and cKDTree is not None
+        rows= dict(abcop=plan['abcop'] and not use_tree,nearest=plan['nearest'] and not use_tree)
+        if pair_sampling is not None and plan['pairs']:
+            with phase_timer(stats,'pair_sums'):
+                sums= sample_pair_sums(cyx,rr,domain_size,period,**pair_sampling)[0]
+            plan= dict(plan,pairs=False)
+        nbk= numba_kernels(backend)
+        if nbk is not None and (plan['pairs'] or rows['abcop'] or rows['nearest']):
+            with phase_timer(stats,'pair_sums'):
+                cop,logd,D2,v1,n1= nbk.pair_kernel_nb(cyx,period[0],period[1],rr,ci[:,-1],
+                                                      float(A_domain),L_domain,float(abcop_crt),
+                                                      plan['pairs'],rows['abcop'],rows['nearest'])
+            if plan['pairs']:
+                sums= (cop,logd,D2)
+            if rows['abcop']: V2max= v1
+            if rows['nearest']: nnd= n1
+        elif plan['pairs'] or rows['abcop'] or rows['nearest']:
+            cop=logd=D2= 0.
+            V2max= np.empty(N) if rows['abcop'] else None
+            nnd= np.empty(N) if rows['nearest'] else None
+            for i0 in range(0,N,nb):
+                i1= min(i0+nb,N)
+                with phase_timer(stats,'distance'):
+                    dd= distance_rows(cyx,i0,i1,period)
+                c1,l1,d1,v1,n1= pair_kernel(dd,i0,rr,ci[:,-1],A_domain,L_domain,abcop_crt,
+                                            pairs=plan['pairs'],stats=stats,**rows)
+                cop+=c1; logd+=l1; D2+=d1
+                if rows['abcop']: V2max[i0:i1]= v1
+                if rows['nearest']: nnd[i0:i1]= n1
+            if plan['pairs']:
+                sums= (cop,logd,D2)
+
+        if use_tree and (plan['abcop'] or plan['nearest']):
+            with phase_timer(stats,'abcop' if plan['abcop'] else 'iorg'):
+                nnd,V2max= nearest_and_abcop_kdtree(cyx,rr,ci[:,-1],domain_size,abcop_crt,channel=channel,
+                                                    periodic_y=periodic_y,abcop=plan['abcop'])
+
+    with phase_timer(stats,'iorg'):
+        oid= org_indexes_from_sums(ci[:,-1],sums,V2max,nnd,domain_size,iorg_method=iorg_method)
+    return tuple(val if ss else np.nan for val,ss in zip(oid,sel))
+
+
+def metric_plan(metrics=None):
+    '''
+    metrics: list of metric names in metric_names (case-insensitive; 'Iorg' for 'I_org' is ok); all if None
+    Output: bool array of selected metrics (in order of metric_names), 
+            and what to calculate: pair sums (SCAI, MCAI, COP), ABCOP, nearest neighbor (Iorg)
+    '''
+
+    if metrics is None:
+        sel= np.ones(len(metric_names),dtype=bool)
+    else:
+        if isinstance(metrics,str):
+            metrics= [metrics]
+        names= [nm.upper().replace('_','') for nm in metric_names]
+        sel= np.zeros(len(metric_names),dtype=bool)
+        for nm in metrics:
+            if nm.upper().replace('_','') not in names:
+                raise ValueError('Unknown metric "{}"; available: {}'.format(nm,metric_names))
+            sel[names.index(nm.upper().replace('_',''))]= True
+    plan= dict(pairs=bool(sel[:3].any()),nearest=bool(sel[3]),abcop=bool(sel[4]))
+    return sel,plan
+
+
+def org_indexes_from_sums(sz,sums,V2max,nnd,domain_size,iorg_method='binned'):
+    '''
+    Final step of calc_org_indexes()
+    sz: size of each aggregate
+    sums: sums over all pairs (i<j) of (r_i+r_j)/d (COP), log(d) (SCAI), and max(d-r_i-r_j,0) (MCAI)
+    V2max, nnd: ABCOP maximum interaction potential and nearest neighbor distance of each aggregate
+    Any of sums, V2max, and nnd can be None if not needed
+    iorg_method: 'binned' or 'exact'; see calc_org_indexes()
+    '''
+
+    ny,nx=domain_size
+    A_domain= nx*ny
+    L_domain= math.sqrt(A_domain) # Length of domain
+
+    N = sz.shape[0]  # Total number of aggregates
     N_tot = (N*(N-1)/2)  # Total number of combination
-    if N>1: rr = np.sqrt(ci[:,-1]/math.pi)  # Estimated radius
-    
-    D0 = 1.; D2= 0.
+
     scai=mcai=99.9
     cop = 0.
     abcop= 0.
-    abcop_crt=1
     Iorg=0.
     tsz=0.
+    if iorg_method not in ('binned','exact'):
+        raise ValueError('iorg_method should be "binned" or "exact": {}'.format(iorg_method))
 
     if N>=2:
-        ### Build distance matrix
-        dd_mtx= np.empty([N,N],dtype=float)
-        for i in range(N):
-            dd_mtx[i,:]= np.sqrt(np.power(ci[:,:2]-ci[i,:2].reshape([1,2]),2).sum(axis=1))
-            dd_mtx[i,i]= 1.e7  ## In order to exclude self
-
-        ### In the case of channel condition
-        if channel:
-            dd_mtx2= np.empty_like(dd_mtx)
-            half_idx= ci[:,1]>=nx/2
-            ci[half_idx,1]-=nx        
-            for i in range(N):
-                dd_mtx2[i,:]= np.sqrt(np.power(ci[:,:2]-ci[i,:2].reshape([1,2]),2).sum(axis=1))
-                dd_mtx2[i,i]= 1.e7
-            dd_mtx= np.minimum(dd_mtx,dd_mtx2)
-
-        
         ### Parameters for SCAI and MCAI
         N_max= L_domain**2/2
         scai_norm= N_max*L_domain
-        
-        ### For all pairs
-        for i in range(N-1):
-            for j in range(i+1,N):
-                # COP
-                cop+=(rr[i]+rr[j])/dd_mtx[i,j]/N_tot
-
-                # SCAI
-                D0*=math.pow(dd_mtx[i,j],1/N_tot)
-
-                # MCAI
-                D2+=max((dd_mtx[i,j]-rr[i]-rr[j]),0)/N_tot
-        scai = N/scai_norm*D0*1000
-        mcai = N/scai_norm*D2*1000
-
-
-        ### For each aggregate
-        nnd = np.empty([N,])  ## nearest neighbor distance for Iorg
-        for i in range(N):
-            dd = dd_mtx[i,:]
-
-            # ABCOP
-            ddv2= dd-rr-rr[i]
-            ddv2[ddv2<abcop_crt]=abcop_crt
-            V2max= ((ci[i,-1]+ci[:,-1])/2/A_domain/(ddv2/L_domain)).max()
-            abcop+= V2max
-
-            # For Iorg
-            nnd[i] = dd.min()                
-                
+
+        if sums is not None:
+            cop= sums[0]/N_tot
+            D0= math.exp(sums[1]/N_tot)  ## Geometric mean as mean of logs (no underflow)
+            D2= sums[2]/N_tot
+            scai = N/scai_norm*D0*1000
+            mcai = N/scai_norm*D2*1000
+        if V2max is not None:
+            abcop= V2max.sum()
+
         ### Iorg
-        #ref_dist0 = np.linspace(0,L_domain*1.5,501)
-        ref_dist0= np.arange(0,L_domain*1.5,0.1)  ## Iorg value change by "step" value
-        ref_dist = (ref_dist0[1:]+ref_dist0[:-1])/2.
-        nnd_random = 1-np.exp(-N/L_domain**2*math.pi*ref_dist**2)
-        nnd = np.cumsum(np.histogram(nnd,bins=ref_dist0)[0]/N)
-        Iorg = np.trapz(nnd,x=nnd_random)
-
-        tsz= ci[:,-1].mean()
+        if nnd is not None and iorg_method=='exact':
+            ## Integral of empirical CDF of nnd over random CDF, F_r(d)= 1-exp(-N/A*pi*d^2)
+            ## = mean of (1-F_r(nnd)), since empirical CDF is a step of 1/N at each nnd
+            Iorg= np.exp(-N/L_domain**2*math.pi*np.square(nnd)).mean()
+        elif nnd is not None:
+            #ref_dist0 = np.linspace(0,L_domain*1.5,501)
+            ref_dist0= np.arange(0,L_domain*1.5,0.1)  ## Iorg value change by "step" value
+            ref_dist = (ref_dist0[1:]+ref_dist0[:-1])/2.
+            nnd_random = 1-np.exp(-N/L_domain**2*math.pi*ref_dist**2)
+            nnd = np.cumsum(np.histogram(nnd,bins=ref_dist0)[0]/N)
+            Iorg = trapz(nnd,x=nnd_random)
+
+        tsz= sz.mean()
     elif N==1:
-        rr = np.sqrt(ci[0,-1]/math.pi)
-        ad= ci[0,-1]/A_domain
+        ad= sz[0]/A_domain
         abcop= np.sqrt(np.pi)/2*ad/(2-np.sqrt(ad))
         
     return scai,mcai,cop,Iorg,abcop,N,tsz
+
+
+tile_nbuf= 12  ## Number of [nb,N] float buffers used for a tile (for mem_limit_mb)
+
+def domain_period(domain_size,channel=False,periodic_y=False):
+    """
+    Period (py,px) of each axis for minimum-image distance; 0 for non-periodic axis
+    """
+    ny,nx= domain_size
+    return (float(ny) if periodic_y else 0., float(nx) if channel else 0.)
+
+
+def min_image(dd,period):
+    """
+    Absolute difference of coordinates (dd; float array, modified in place), 
+        as minimum image if period>0
+    """
+    np.abs(dd,out=dd)
+    if period>0:
+        np.mod(dd,period,out=dd)
+        np.minimum(dd,period-dd,out=dd)
+    return dd
+
+
+def distance_rows(cyx,i0,i1,period=(0.,0.)):
+    """
+    Rows i0:i1 of distance matrix, [i1-i0,N]
+    cyx: [N,2] center (y,x) of aggregates
+    period: (py,px) of domain for minimum-image distance on periodic axes (see domain_period())
+    Self distance is set to a large value in order to be excluded
+    """
+
+    dy= min_image(cyx[i0:i1,0,np.newaxis]-cyx[np.newaxis,:,0],period[0])
+    dx= min_image(cyx[i0:i1,1,np.newaxis]-cyx[np.newaxis,:,1],period[1])
+    dd= np.sqrt(dy*dy+dx*dx)
+    dd[np.arange(i1-i0),np.arange(i0,i1)]= 1.e7
+    return dd
+
+
+def pair_kernel(dd,i0,rr,sz,A_domain,L_domain,abcop_crt=1,pairs=True,abcop=True,nearest=True,stats=None):
+    """
+    Vectorized kernel over rows i0:i0+nb of distance matrix
+    dd: [nb,N] distances from aggregate i0..i0+nb-1 to all; self is excluded by a large value
+    rr, sz: radius and size of all aggregates
+    pairs, abcop, nearest: if False, pair sums (0.), V2max (None), or nnd (None) is skipped
+    stats: OrgMetricsStats; time of pair_sums, abcop, and iorg (nearest) phases is added
+
+    Output:
+        cop, logd, d2: sums over pairs (i<j) in these rows 
+                       for COP, SCAI (log of distance), and MCAI
+        V2max: ABCOP maximum interaction potential of each row
+        nnd: nearest neighbor distance of each row (for Iorg)
+    """
+
+    nb,N= dd.shape
+    ii= np.arange(i0,i0+nb)
+    rsum= rr[ii,np.newaxis]+rr[np.newaxis,:]
+
+    ## Pairs (i<j): all columns after this tile, and upper triangle of the diagonal block
+    cop,logd,d2= 0.,0.,0.
+    if pairs:
+        with phase_timer(stats,'pair_sums'):
+            iu,ju= np.triu_indices(nb,k=1)
+            for d_up,r_up in [(dd[:,i0+nb:],rsum[:,i0+nb:]),(dd[iu,ju+i0],rsum[iu,ju+i0])]:
+                with np.errstate(divide='ignore'):
+                    cop+= (r_up/d_up).sum()
+                    logd+= np.log(d_up).sum()
+                d2+= np.maximum(d_up-r_up,0).sum()
+
+    ## ABCOP
+    V2max= None
+    if abcop:
+        with phase_timer(stats,'abcop'):
+            ddv2= np.maximum(dd-rsum,abcop_crt)
+            V2max= ((sz[ii,np.newaxis]+sz[np.newaxis,:])/2/A_domain/(ddv2/L_domain)).max(axis=1)
+
+    nnd= None
+    if nearest:
+        with phase_timer(stats,'iorg'):
+            nnd= dd.min(axis=1)
+    return cop,logd,d2,V2max,nnd
+
+
+def nearest_and_abcop_kdtree(cyx,rr,sz,domain_size,abcop_crt=1,channel=False,periodic_y=False,abcop=True,
+                             k0=8,n_big=32,max_pairs=2**20):
+    """
+    Nearest neighbor distance (for Iorg) and ABCOP maximum interaction potential
+        of each aggregate by KD-tree of centers, instead of full rows of distance matrix
+    For channel condition (and periodic_y), distance in x (and y) is periodic (minimum image)
+
+    ABCOP: V2max is first guessed from k0 nearest neighbors and from all pairs with the n_big largest aggregates
+        (by brute force), then searched exactly within the radius beyond which V2 cannot exceed the guess.
+        Other aggregates are split into size classes (factor 4 in size), each with its own tree and radius:
+        V2(d) <= (sz_i+sz_max)/2/A_domain*L_domain/(d-rr_i-rr_max), with sz_max, rr_max of the class,
+        so a few large aggregates do not stretch the search radius of all
+        (skipped and V2max is None if abcop==False)
+    max_pairs: number of neighbor pairs handled at once (memory bound of each query)
+    """
+
+    ny,nx= domain_size
+    A_domain= nx*ny
+    L_domain= math.sqrt(A_domain)
+    N= cyx.shape[0]
+
+    ## Non-periodic axis is given a box larger than any distance in the domain
+    pts= np.copy(cyx)
+    big= 3.*(ny+nx)
+    period= domain_period(domain_size,channel=channel,periodic_y=periodic_y)
+    for k,n in enumerate(period):
+        if n>0:
+            pts[:,k]%= n
+            pts[pts[:,k]>=n,k]-= n
+        else:
+            pts[:,k]-= min(pts[:,k].min(),0)
+    d_max= math.hypot(*[n/2 if n>0 else m for n,m in zip(period,domain_size)])
+    boxsize= [n if n>0 else big for n in period]
+    tree= cKDTree(pts,boxsize=boxsize)
+
+    def dist(ii,jj):
+        dy= min_image(pts[ii,0]-pts[jj,0],period[0])
+        dx= min_image(pts[ii,1]-pts[jj,1],period[1])
+        return np.sqrt(dy*dy+dx*dx)
+
+    def v2(i,j,d):
+        return (sz[i]+sz[j])/2/A_domain/(np.maximum(d-rr[i]-rr[j],abcop_crt)/L_domain)
+
+    ## Nearest neighbors; self is excluded by index (centers may coincide)
+    dk,jk= tree.query(pts,k=min(N,k0+1) if abcop else 2)
+    ik= np.repeat(np.arange(N)[:,np.newaxis],jk.shape[1],axis=1)
+    others= jk!=ik
+    nnd= np.where(others,dk,np.inf).min(axis=1)
+    if not abcop:
+        return nnd,None
+    V2max= np.where(others,v2(ik,jk,dk),0.).max(axis=1)
+
+    ## All pairs with the largest aggregates, by brute force
+    nb= min(N,n_big)
+    jb= np.argsort(sz,kind='stable')[N-nb:]
+    rows= max(1,max_pairs//nb)
+    for i0 in range(0,N,rows):
+        ii= np.arange(i0,min(i0+rows,N))[:,np.newaxis]
+        vv= v2(ii,jb[np.newaxis,:],dist(ii,jb[np.newaxis,:]))
+        vv[ii==jb[np.newaxis,:]]= 0.
+        V2max[ii[:,0]]= np.maximum(V2max[ii[:,0]],vv.max(axis=1))
+        np.maximum.at(V2max,jb,vv.max(axis=0))
+
+    ## Other aggregates by size class; one tree and search radius per class
+    rest= np.ones(N,dtype=bool)
+    rest[jb]= False
+    rest= np.nonzero(rest)[0]
+    cls= np.floor(np.log(sz[rest])/math.log(4)).astype(int)
+    for c in np.unique(cls):
+        mem= rest[cls==c]
+        ctree= cKDTree(pts[mem],boxsize=boxsize)
+        sz_max,rr_max= sz[mem].max(),rr[mem].max()
+        r_srch= rr+rr_max+np.maximum((sz+sz_max)*L_domain/2/A_domain/V2max,abcop_crt)
+        r_srch= np.minimum(r_srch,d_max)*(1+1.e-9)
+
+        ## Rows are split so that each query returns at most about max_pairs neighbors
+        cnt= ctree.query_ball_point(pts,r_srch,return_length=True)
+        cum= np.cumsum(cnt)
+        i0= 0
+        while i0<N:
+            i1= max(i0+1,int(np.searchsorted(cum,(cum[i0-1] if i0>0 else 0)+max_pairs,side='right')))
+            i1= min(i1,N)
+            nbrs= ctree.query_ball_point(pts[i0:i1],r_srch[i0:i1],return_sorted=False)
+            jj= mem[np.fromiter((j for nb in nbrs for j in nb),dtype=int,count=cnt[i0:i1].sum())]
+            ii= np.repeat(np.arange(i0,i1),cnt[i0:i1])
+            jj,ii= jj[jj!=ii],ii[jj!=ii]
+            np.maximum.at(V2max,ii,v2(ii,jj,dist(ii,jj)))
+            i0= i1
+
+    return nnd,V2max
+
+
+def pair_strata(cyx,domain_size,period=(0.,0.),n_strata=8,n_block=None):
+    """
+    Strata of pairs by distance, for sampling of pairs (see sample_pair_sums())
+    Aggregates are grouped by blocks of a coarse grid (n_block per axis), 
+        and pairs of blocks are grouped by distance between block centers into strata of similar number of pairs
+        (pairs in the same block are the first stratum)
+    Output: 
+        order: aggregates sorted by block; start, count: of each block in order
+        strata: list of (block a, block b, cumulative number of pairs of block pairs)
+    """
+
+    N= cyx.shape[0]
+    ny,nx= domain_size
+    G= n_block if n_block is not None else int(min(16,max(1,math.sqrt(N/16))))
+    by= np.minimum((cyx[:,0]*G/ny).astype(int),G-1)
+    bx= np.minimum((cyx[:,1]*G/nx).astype(int),G-1)
+    blk= by*G+bx
+    order= np.argsort(blk,kind='stable')
+    count= np.bincount(blk,minlength=G*G)
+    start= np.concatenate([[0],np.cumsum(count)[:-1]])
+
+    ## Pairs of non-empty blocks (a<=b)
+    nz= np.nonzero(count)[0]
+    ia,ib= np.triu_indices(nz.size)
+    a,b= nz[ia],nz[ib]
+    npair= np.where(a==b,count[a]*(count[a]-1)//2,count[a]*count[b]).astype(np.int64)
+    keep= npair>0
+    a,b,npair= a[keep],b[keep],npair[keep]
+
+    dy= min_image(((a//G-b//G)*(ny/G)).astype(float),period[0])
+    dx= min_image(((a%G-b%G)*(nx/G)).astype(float),period[1])
+    dist= np.sqrt(dy*dy+dx*dx)
+    idx= np.argsort(dist,kind='stable')
+    a,b,npair,dist= a[idx],b[idx],npair[idx],dist[idx]
+    ## Same block: stratum 0; others split by distance into strata of similar number of pairs
+    near= dist==0
+    grp= np.zeros(a.size,dtype=int)
+    far= np.nonzero(~near)[0]
+    if far.size>0:
+        nf= max(1,n_strata-1)
+        cum= np.cumsum(npair[far])-npair[far]
+        grp[far]= 1+np.minimum((cum*nf/npair[far].sum()).astype(int),nf-1)
+    strata= [(a[grp==h],b[grp==h],np.cumsum(npair[grp==h])) for h in np.unique(grp)]
+    return order,start,count,strata
+
+
+def pair_values(cyx,rr,ii,jj,period=(0.,0.)):
+    """
+    Terms of pair sums of COP, SCAI (log of distance), and MCAI for pairs (ii,jj); [3,n]
+    """
+
+    dy= min_image(cyx[ii,0]-cyx[jj,0],period[0])
+    dx= min_image(cyx[ii,1]-cyx[jj,1],period[1])
+    dd= np.sqrt(dy*dy+dx*dx)
+    rsum= rr[ii]+rr[jj]
+    with np.errstate(divide='ignore'):
+        return np.stack([rsum/dd,np.log(dd),np.maximum(dd-rsum,0)])
+
+
+def stratum_pairs(stratum,start,count,n=None,rg=None):
+    """
+    Pairs (index in block order) of a stratum: all pairs if n is None, otherwise n random pairs
+        (uniform over pairs of the stratum, with replacement)
+    """
+
+    a,b,cum= stratum
+    if n is None:
+        ## All pairs; ordered pairs in same block are reduced to i<j
+        m= np.where(a==b,count[a]**2,count[a]*count[b])
+        k= np.repeat(np.arange(a.size),m)
+        off= np.arange(m.sum())-np.repeat(np.cumsum(m)-m,m)
+        li,lj= np.divmod(off,count[b][k])
+        ok= (a[k]!=b[k]) | (li<lj)
+        k,li,lj= k[ok],li[ok],lj[ok]
+    else:
+        k= np.searchsorted(cum,rg.random(n)*cum[-1],side='right')
+        li= (rg.random(n)*count[a][k]).astype(np.int64)
+        same= a[k]==b[k]
+        lj= (rg.random(n)*(count[b][k]-same)).astype(np.int64)
+        lj+= same & (lj>=li)  ## j!=i in the same block
+    return start[a][k]+li, start[b][k]+lj
+
+
+def sample_pair_sums(cyx,rr,domain_size,period=(0.,0.),rel_tol=0.01,time_budget=None,conf=0.95,seed=None,
+                     n_strata=8,batch=4096,max_pairs=None):
+    """
+    Estimate sums over all pairs (i<j) of pair_values() by stratified sampling of pairs (see pair_strata())
+    Rounds of samples are allocated to strata by Neyman allocation (more to strata of larger spread),
+        until the confidence interval of each of SCAI, MCAI, COP is within rel_tol (relative half-width),
+        time_budget (sec) is spent, or max_pairs are sampled
+    A stratum is summed exactly if it has no more pairs than its allocation
+        (so small N is exact, with zero-width interval)
+    Output: sums [3] (COP, log d, MCAI terms; as in pair_kernel()), half-width of the interval of sums [3], 
+            number of pairs evaluated
+    """
+
+    tic= time.perf_counter()
+    N= cyx.shape[0]
+    N_tot= N*(N-1)/2
+    zz= NormalDist().inv_cdf((1+conf)/2)
+    rg= np.random.default_rng(seed)
+    order,start,count,strata= pair_strata(cyx,domain_size,period,n_strata=n_strata)
+    cyx,rr= cyx[order],rr[order]
+
+    H= len(strata)
+    P= np.array([st[2][-1] for st in strata],dtype=float)
+    n= np.zeros(H); s1= np.zeros([H,3]); s2= np.zeros([H,3])
+    exact= np.zeros(H,dtype=bool)
+    alloc= np.minimum(P,max(64,batch//H))
+    while True:
+        for h in np.nonzero(alloc>0)[0]:
+            if n[h]+alloc[h]>=P[h]:
+                vals= pair_values(cyx,rr,*stratum_pairs(strata[h],start,count),period=period)
+                n[h]= P[h]; exact[h]= True
+                s1[h]= vals.mean(axis=1); s2[h]= 0.
+            else:
+                vals= pair_values(cyx,rr,*stratum_pairs(strata[h],start,count,int(alloc[h]),rg),period=period)
+                n[h]+= alloc[h]
+                s1[h]+= vals.sum(axis=1); s2[h]+= np.square(vals).sum(axis=1)
+        m1= np.where(exact[:,None],s1,s1/np.maximum(n,1)[:,None])
+        with np.errstate(invalid='ignore'):
+            var= np.where(exact[:,None],0.,np.maximum(s2/np.maximum(n,1)[:,None]-m1**2,0)*n[:,None]/np.maximum(n-1,1)[:,None])
+        sums= (P[:,None]*m1).sum(axis=0)
+        half= zz*np.sqrt((P[:,None]**2*var/np.maximum(n,1)[:,None]).sum(axis=0))
+
+        ## Relative half-width of SCAI, MCAI, COP (SCAI is exp of mean log d)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            rel= np.array([math.expm1(half[1]/N_tot),half[2]/abs(sums[2]),half[0]/abs(sums[0])])
+        done= exact.all() or np.all(np.nan_to_num(rel,nan=0.)<=rel_tol)
+        if done or (time_budget is not None and time.perf_counter()-tic>time_budget) or \
+           (max_pairs is not None and n.sum()>=max_pairs):
+            break
+
+        ## Neyman allocation for the metric of the widest interval
+        sd= np.sqrt(var)
+        k= int(np.nanargmax(rel))
+        w= np.where(exact,0.,P*sd[:,k])
+        if not np.isfinite(w).all() or w.sum()==0:
+            w= np.where(exact,0.,P)
+        ## Next round: projected number of samples to reach rel_tol (at most 4 times of samples so far)
+        ntot= n[~exact].sum()
+        target= ntot*(float(np.nanmax(rel))/rel_tol)**2 if rel_tol>0 else 4*ntot
+        batch= int(min(max(target-ntot,batch),4*ntot+batch))
+        if time_budget is not None:
+            ## Not more than what fits in the remaining time at the rate so far
+            elapsed= time.perf_counter()-tic
+            batch= int(max(H,min(batch,n.sum()/elapsed*(time_budget-elapsed))))
+        alloc= np.minimum(np.ceil(batch*w/w.sum()),P-n)
+    return sums, half, int(n.sum())
+
+
+def approx_pair_indexes(c_info,domain_size,channel=False,periodic_y=False,**sampling):
+    """
+    SCAI, MCAI, and COP estimated by sampling of pairs, with confidence interval
+    sampling: options for sample_pair_sums() (rel_tol, time_budget, conf, seed, n_strata, batch, max_pairs)
+    Output: estimate [3], lower and upper bound [3] (SCAI, MCAI, COP), number of pairs evaluated
+    """
+
+    ci= np.array(c_info,dtype=float).reshape([-1,3])
+    N= ci.shape[0]
+    if N<2:
+        oid= np.array(org_indexes_from_sums(ci[:,-1],None,None,None,domain_size)[:3])
+        return oid,oid,oid,0
+    rr= np.sqrt(ci[:,-1]/math.pi)
+    sums,half,n= sample_pair_sums(ci[:,:2],rr,domain_size,domain_period(domain_size,channel,periodic_y),**sampling)
+    est,lo,hi= (np.array(org_indexes_from_sums(ci[:,-1],ss,None,None,domain_size)[:3])
+                for ss in (sums,sums-half,sums+half))
+    return est,lo,hi,n
+
+
+def init_incremental_state(amap,diag=False,channel=False,periodic_y=False,iorg_method='binned'):
+    """
+    Label a 2d array (amap) and keep what is needed to update Org. metrics incrementally 
+        for following frames (see update_incremental_state())
+    Output: state (dict); Org. metrics of amap is incremental_org_indexes(state)
+    """
+
+    amap= np.array(amap,dtype=bool)
+    labels,c_info= label_aggregates(amap,diag=diag,channel=channel,periodic_y=periodic_y)
+    N= c_info.shape[0]
+    state= dict(amap=amap,labels=labels,c_info=c_info,ids=np.arange(1,N+1),next_id=N+1,
+                diag=diag,channel=channel,periodic_y=periodic_y,iorg_method=iorg_method)
+    refresh_pair_state(state)
+    return state
+
+
+def incremental_org_indexes(state):
+    """
+    Org. metrics of the current frame in state, same as calc_org_indexes()
+    """
+
+    return org_indexes_from_sums(state['c_info'][:,-1],state['sums'],state['V2max'],state['nnd'],
+                                 state['amap'].shape,iorg_method=state['iorg_method'])
+
+
+def update_incremental_state(state,amap,changed=None):
+    """
+    Update aggregates and Org. metrics of the previous frame in state to a new frame (amap)
+    changed: (iy,ix) of changed grid cells; if None, found by comparing to the previous frame
+    Only aggregates touching changed cells are relabeled (including split and merge), 
+        and only pairs involving those aggregates are updated in pair sums
+    Output: Org. metrics of the new frame; state is updated in place
+    """
+
+    amap= np.array(amap,dtype=bool)
+    ny,nx= amap.shape
+    diag,channel,periodic_y= state['diag'],state['channel'],state['periodic_y']
+    labels= state['labels']
+    if changed is None:
+        cy,cx= np.nonzero(amap!=state['amap'])
+    else:
+        cy,cx= np.asarray(changed[0]),np.asarray(changed[1])
+    state['amap']= amap
+    if cy.size==0:
+        return incremental_org_indexes(state)
+
+    ## Old aggregates touching changed cells (the cells themselves and their neighbors)
+    offsets= [(0,0),(-1,0),(1,0),(0,-1),(0,1)]
+    if diag:
+        offsets+= [(-1,-1),(-1,1),(1,-1),(1,1)]
+    touched=[]
+    for dy,dx in offsets:
+        y1,x1= cy+dy, cx+dx
+        if periodic_y:
+            y1= y1%ny
+        if channel:
+            x1= x1%nx
+            ok= (y1>=0) & (y1<ny)
+        else:
+            ok= (y1>=0) & (y1<ny) & (x1>=0) & (x1<nx)
+        touched.append(labels[y1[ok],x1[ok]])
+    affected= np.unique(np.concatenate(touched))
+    affected= affected[affected>0]
+
+    ## Relabel the cells of affected aggregates and changed cells; they form whole new aggregates
+    old_mask= np.isin(labels,affected)
+    new_mask= np.copy(old_mask)
+    new_mask[cy,cx]= True
+    new_mask&= amap
+    iy,ix= np.nonzero(new_mask)
+    root= connect_cells(iy,ix,(ny,nx),diag=diag,channel=channel,periodic_y=periodic_y)
+    is_root= root==np.arange(root.size)
+    lab= (np.cumsum(is_root)-1)[root]
+    M= int(is_root.sum())
+    q_ids= np.arange(state['next_id'],state['next_id']+M)
+    q_info= aggregate_info(lab,M,iy,ix,(ny,nx),channel=channel,periodic_y=periodic_y)
+
+    labels[old_mask]= 0
+    labels[iy,ix]= q_ids[lab]
+    state['next_id']+= M
+
+    keep= ~np.isin(state['ids'],affected)
+    if keep.sum()<keep.size/2:
+        ## Most aggregates changed: pair sums from scratch
+        state['c_info']= np.concatenate([state['c_info'][keep],q_info])
+        state['ids']= np.concatenate([state['ids'][keep],q_ids])
+        refresh_pair_state(state)
+    else:
+        update_pair_state(state,keep,q_info,q_ids)
+    return incremental_org_indexes(state)
+
+
+def refresh_pair_state(state,max_elem=2**20):
+    """
+    Pair sums and per-aggregate ABCOP V2max and nearest neighbor (with partner ids) from scratch
+    """
+
+    ci,ids= state['c_info'],state['ids']
+    domain_size= state['amap'].shape
+    N= ci.shape[0]
+    sums= np.zeros(3)
+    state['V2max'],state['V2arg']= np.zeros(N),np.zeros(N,dtype=ids.dtype)
+    state['nnd'],state['nnarg']= np.full(N,np.inf),np.zeros(N,dtype=ids.dtype)
+
+    nb= max(1,max_elem//max(N,1))
+    for i0 in range(0,N,nb):
+        i1= min(i0+nb,N)
+        terms= pair_block(ci[i0:i1],ci,domain_size,channel=state['channel'],periodic_y=state['periodic_y'])
+        upper= np.arange(N)[np.newaxis,:]>np.arange(i0,i1)[:,np.newaxis]
+        sums+= [tt[upper].sum() for tt in terms[1:4]]
+        set_partner_rows(state,np.arange(i0,i1),terms,ids)
+    state['sums']= sums
+    return
+
+
+def update_pair_state(state,keep,q_info,q_ids):
+    """
+    Remove pairs involving removed aggregates (~keep), and add pairs involving new aggregates (q_info)
+    Rows of kept aggregates are recomputed only if their ABCOP or nearest partner is removed
+    """
+
+    domain_size,channel,periodic_y= state['amap'].shape,state['channel'],state['periodic_y']
+    ci,ids= state['c_info'],state['ids']
+    sums= state['sums']
+
+    ## Pairs involving removed aggregates: with kept ones, and among themselves (i<j)
+    rm= ~keep
+    if rm.any():
+        terms= pair_block(ci[rm],ci,domain_size,channel=channel,periodic_y=periodic_y)
+        nr= rm.sum()
+        upper= np.zeros([nr,ci.shape[0]],dtype=bool)
+        upper[:,keep]= True
+        upper[:,rm]= np.arange(nr)[np.newaxis,:]>np.arange(nr)[:,np.newaxis]
+        sums-= [tt[upper].sum() for tt in terms[1:4]]
+
+    ## Pairs involving new aggregates: with kept ones, and among themselves (i<j)
+    ck,kid= ci[keep],ids[keep]
+    nq= q_info.shape[0]
+    t_qk= pair_block(q_info,ck,domain_size,channel=channel,periodic_y=periodic_y)
+    t_qq= pair_block(q_info,q_info,domain_size,channel=channel,periodic_y=periodic_y)
+    upper= np.arange(nq)[np.newaxis,:]>np.arange(nq)[:,np.newaxis]
+    sums+= [tt.sum()+uu[upper].sum() for tt,uu in zip(t_qk[1:4],t_qq[1:4])]
+
+    ## Kept rows: compare to new aggregates, unless their partner is removed
+    removed_ids= ids[rm]
+    for key in ['V2max','V2arg','nnd','nnarg']:
+        state[key]= state[key][keep]
+    if nq>0:
+        j= t_qk[4].argmax(axis=0)
+        v= t_qk[4][j,np.arange(ck.shape[0])]
+        better= v>state['V2max']
+        state['V2max'][better],state['V2arg'][better]= v[better],q_ids[j[better]]
+        j= t_qk[0].argmin(axis=0)
+        d= t_qk[0][j,np.arange(ck.shape[0])]
+        better= d<state['nnd']
+        state['nnd'][better],state['nnarg'][better]= d[better],q_ids[j[better]]
+
+    state['c_info']= np.concatenate([ck,q_info])
+    state['ids']= np.concatenate([kid,q_ids])
+    for key,val in zip(['V2max','V2arg','nnd','nnarg'],[0.,0,np.inf,0]):
+        state[key]= np.concatenate([state[key],np.full(nq,val,dtype=state[key].dtype)])
+    state['sums']= sums
+
+    ## New rows and kept rows whose partner is removed
+    lost= np.isin(state['V2arg'],removed_ids) | np.isin(state['nnarg'],removed_ids)
+    lost[ck.shape[0]:]= True
+    rows= np.nonzero(lost)[0]
+    if rows.size>0:
+        terms= pair_block(state['c_info'][rows],state['c_info'],domain_size,channel=channel,
+                          periodic_y=periodic_y)
+        set_partner_rows(state,rows,terms,state['ids'])
+
+    if not np.isfinite(sums).all():
+        ## e.g., coincident centers (d=0) cannot be subtracted
+        refresh_pair_state(state)
+    return
+
+
+def set_partner_rows(state,rows,terms,ids):
+    """
+    Set V2max and nearest neighbor (with partner ids) of given rows from pair_block() terms vs. all
+    """
+
+    if ids.size==0:
+        return
+    dd,v2= np.copy(terms[0]),np.copy(terms[4])
+    self_idx= ids[rows][:,np.newaxis]==ids[np.newaxis,:]
+    dd[self_idx]= np.inf; v2[self_idx]= 0.
+    ja,jn= v2.argmax(axis=1),dd.argmin(axis=1)
+    ii= np.arange(rows.size)
+    state['V2max'][rows],state['V2arg'][rows]= v2[ii,ja],ids[ja]
+    state['nnd'][rows],state['nnarg'][rows]= dd[ii,jn],ids[jn]
+    return
+
+
+def pair_block(ca,cb,domain_size,channel=False,periodic_y=False,abcop_crt=1):
+    """
+    All pairs between two sets of aggregates, ca [Na,3] and cb [Nb,3] (center_y, center_x, size)
+    Output: [Na,Nb] arrays of distance, COP term (r_a+r_b)/d, log(d) for SCAI, 
+            max(d-r_a-r_b,0) for MCAI, and ABCOP interaction potential V2
+    Distance is the same as in calc_org_indexes()
+    """
+
+    ny,nx= domain_size
+    A_domain= nx*ny
+    L_domain= math.sqrt(A_domain)
+
+    period= domain_period(domain_size,channel=channel,periodic_y=periodic_y)
+    dy= min_image(ca[:,0,np.newaxis]-cb[np.newaxis,:,0],period[0])
+    dx= min_image(ca[:,1,np.newaxis]-cb[np.newaxis,:,1],period[1])
+    dd= np.sqrt(dy*dy+dx*dx)
+
+    rsum= np.sqrt(ca[:,2]/math.pi)[:,np.newaxis]+np.sqrt(cb[:,2]/math.pi)[np.newaxis,:]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        cop= rsum/dd
+        logd= np.log(dd)
+    d2= np.maximum(dd-rsum,0)
+    v2= (ca[:,2,np.newaxis]+cb[np.newaxis,:,2])/2/A_domain/(np.maximum(dd-rsum,abcop_crt)/L_domain)
+    return dd,cop,logd,d2,v2
@@ -0,0 +1,88 @@
+'''
+Numba-compiled kernels for calc_org_metrics_module (backend='numba')
+
+Same algorithms as NumPy version, but in loops without temporary arrays:
+    connect_cells_nb: union-find of active cells (same roots as connect_cells())
+    pair_kernel_nb: pair sums, ABCOP, and nearest neighbor distance over all pairs (i<j) at once,
+                    so memory is O(N) instead of rows of distance matrix
+Compiled functions are cached on disk (cache=True), so compile cost is paid once
+'''
+
+import numpy as np
+import math
+from numba import njit
+
+@njit(cache=True)
+def find_root(parent,i):
+    while parent[i]!=i:
+        parent[i]= parent[parent[i]]  ## Path halving
+        i= parent[i]
+    return i
+
+@njit(cache=True)
+def connect_cells_nb(key,iy,ix,ny,nx,diag,channel,periodic_y,t_key):
+    '''
+    key: sorted cell keys (iy*nx+ix, plus t_key for frame)
+    Output: index of root cell (first cell in row-major order of the aggregate) for each cell
+    '''
+    n= key.size
+    parent= np.arange(n)
+    if diag:
+        dys= np.array([0,1,1,1]); dxs= np.array([1,0,1,-1])
+    else:
+        dys= np.array([0,1]); dxs= np.array([1,0])
+
+    for k in range(n):
+        for m in range(dys.size):
+            y1= iy[k]+dys[m]; x1= ix[k]+dxs[m]
+            if periodic_y:
+                y1= y1%ny
+            elif y1>=ny:
+                continue
+            if channel:
+                x1= x1%nx
+            elif x1<0 or x1>=nx:
+                continue
+            nkey= y1*nx+x1+t_key[k]
+            loc= np.searchsorted(key,nkey)
+            if loc<n and key[loc]==nkey:
+                ra= find_root(parent,k); rb= find_root(parent,loc)
+                if ra<rb:
+                    parent[rb]= ra
+                elif rb<ra:
+                    parent[ra]= rb
+
+    for k in range(n):
+        parent[k]= find_root(parent,k)
+    return parent
+
+@njit(cache=True,error_model='numpy')
+def pair_kernel_nb(cyx,py,px,rr,sz,A_domain,L_domain,abcop_crt,pairs,abcop,nearest):
+    '''
+    cyx: [N,2] centers; py, px: period of y and x for minimum-image distance (0 if not periodic)
+    Output: cop, logd, d2 (sums over pairs i<j), V2max [N], nnd [N]; see pair_kernel()
+    '''
+    N= cyx.shape[0]
+    cop=logd=d2= 0.
+    V2max= np.zeros(N)
+    nnd= np.full(N,np.inf)
+    for i in range(N):
+        for j in range(i+1,N):
+            dy= abs(cyx[i,0]-cyx[j,0])
+            dx= abs(cyx[i,1]-cyx[j,1])
+            if py>0:
+                dy= dy%py; dy= min(dy,py-dy)
+            if px>0:
+                dx= dx%px; dx= min(dx,px-dx)
+            d= math.sqrt(dy*dy+dx*dx)
+            rsum= rr[i]+rr[j]
+            if pairs:
+                cop+= rsum/d
+                logd+= math.log(d) if d>0 else -np.inf
+                d2+= max(d-rsum,0.)
+            if abcop:
+                v2= (sz[i]+sz[j])/2/A_domain/(max(d-rsum,abcop_crt)/L_domain)
+                V2max[i]= max(V2max[i],v2); V2max[j]= max(V2max[j],v2)
+            if nearest:
+                nnd[i]= min(nnd[i],d); nnd[j]= min(nnd[j],d)
+    return cop,logd,d2,V2max,nnd
@@ -0,0 +1,109 @@
+'''
+Catalog of aggregates (per-aggregate table) as a reusable intermediate product
+
+Labeling is the dominant cost, while aggregates of a scene are only a few numbers each,
+so the catalog is kept and Org. metrics can be recalculated with other options (metrics, iorg_method, ...)
+without labeling again.
+Columns (ragged by frame; aggregates of frame t are offsets[t]:offsets[t+1]):
+    frame, cy, cx, size; optionally bbox [M,4] (y0,y1,x0,x1; inclusive, not unwrapped on periodic axes)
+    and labels [nt,ny,nx] (0 for background, 1..M over all frames)
+Usage:
+    cat= build_catalog(arr,diag=True,bbox=True)
+    save_catalog('./scenes.catalog.npz',cat)
+    metrics= org_indices_of_catalog(load_catalog('./scenes.catalog.npz'),iorg_method='exact')
+'''
+
+import numpy as np
+import os
+import calc_org_metrics_module as com
+
+def build_catalog(amap0,diag=False,channel=False,periodic_y=False,bbox=False,labels=False,packed_nx=None,
+                  stats=None,backend='numpy',t_offset=0):
+    '''
+    Label all frames of amap0 [nt,ny,nx] (or [ny,nx]) and make a catalog (dict of arrays)
+    t_offset: frame index of the first frame (e.g., for chunks of a long record)
+    '''
+    amap0= np.asarray(amap0)
+    if amap0.ndim==2:
+        amap0= amap0[np.newaxis,:]
+    nt,ny,nx= amap0.shape
+    if packed_nx is not None:
+        nx= packed_nx
+
+    with com.phase_timer(stats,'labeling'):
+        it,iy,ix= com.active_cells(amap0,packed=packed_nx is not None)
+    lab,c_info,n_agg= com.label_cells(it,iy,ix,nt,(ny,nx),diag=diag,channel=channel,periodic_y=periodic_y,
+                                      stats=stats,backend=backend)
+    cat= from_info(c_info,n_agg,(ny,nx),diag=diag,channel=channel,periodic_y=periodic_y,t_offset=t_offset)
+
+    M= c_info.shape[0]
+    if bbox:
+        bb= np.empty([M,4],dtype=np.int32)
+        bb[:,0]= np.iinfo(np.int32).max; bb[:,1]= -1
+        bb[:,2]= np.iinfo(np.int32).max; bb[:,3]= -1
+        np.minimum.at(bb[:,0],lab,iy); np.maximum.at(bb[:,1],lab,iy)
+        np.minimum.at(bb[:,2],lab,ix); np.maximum.at(bb[:,3],lab,ix)
+        cat['bbox']= bb
+    if labels:
+        lmap= np.zeros([nt,ny,nx],dtype=np.int32 if M<np.iinfo(np.int32).max else np.int64)
+        lmap[it,iy,ix]= lab+1
+        cat['labels']= lmap
+    return cat
+
+def from_info(c_info,n_agg,domain_size,diag=False,channel=False,periodic_y=False,t_offset=0):
+    '''
+    Catalog from output of label_aggregates_stack() (c_info [M,3], n_agg [nt])
+    '''
+    n_agg= np.asarray(n_agg,dtype=np.int64)
+    return dict(offsets=np.concatenate([[0],np.cumsum(n_agg)]).astype(np.int64),
+                frame=np.repeat(np.arange(t_offset,t_offset+n_agg.size,dtype=np.int64),n_agg),
+                cy=np.ascontiguousarray(c_info[:,0]),cx=np.ascontiguousarray(c_info[:,1]),
+                size=c_info[:,2].astype(np.int64),
+                domain_size=np.asarray(domain_size,dtype=np.int64),
+                flags=np.array([diag,channel,periodic_y],dtype=bool),t_offset=np.int64(t_offset))
+
+def c_info_of(cat):
+    '''
+    c_info [M,3] and n_agg [nt] of a catalog, as from label_aggregates_stack()
+    '''
+    return np.stack([cat['cy'],cat['cx'],cat['size'].astype(float)],axis=1), np.diff(cat['offsets'])
+
+def concat_catalogs(cats):
+    '''
+    One catalog of consecutive chunks (e.g., built with t_offset of each chunk)
+    '''
+    out= dict(cats[0])
+    for name in ['frame','cy','cx','size','bbox']:
+        if name in out:
+            out[name]= np.concatenate([cat[name] for cat in cats])
+    out['offsets']= np.concatenate([[0],np.cumsum(np.concatenate([np.diff(cat['offsets']) for cat in cats]))])
+    if 'labels' in out:
+        ## Labels are numbered over the whole catalog
+        shift= np.cumsum([0]+[cat['cy'].size for cat in cats[:-1]])
+        out['labels']= np.concatenate([np.where(cat['labels']>0,cat['labels']+s,0).astype(cat['labels'].dtype)
+                                       for cat,s in zip(cats,shift)])
+    return out
+
+def org_indices_of_catalog(cat,stats=None,backend='numpy',**calc_opts):
+    '''
+    Org. metrics of each frame from a catalog, without labeling
+    calc_opts: options for calc_org_indexes() (mem_limit_mb, spatial_index, metrics, iorg_method)
+    Periodic axes are those of the catalog, since centroids depend on them
+    Output: float array [nt,7]; see calc_org_indexes()
+    '''
+    c_info,n_agg= c_info_of(cat)
+    _,channel,periodic_y= (bool(v) for v in cat['flags'])
+    t0= int(cat['t_offset'])
+    return com.org_indices_of_info(c_info,n_agg,tuple(int(n) for n in cat['domain_size']),channel=channel,
+                                   periodic_y=periodic_y,stats=stats,t_index=np.arange(t0,t0+n_agg.size),
+                                   backend=backend,**calc_opts)
+
+def save_catalog(fn,cat):
+    tmp= fn+'.{}.tmp.npz'.format(os.getpid())
+    np.savez_compressed(tmp,**cat)
+    os.replace(tmp,fn)  ## Atomic, so a killed job never leaves a broken catalog
+    return
+
+def load_catalog(fn):
+    with np.load(fn) as f:
+        return {k:f[k] for k in f.files}
@@ -0,0 +1,118 @@
+'''
+Content-addressed cache of Org. metrics for repeated scenes
+
+Key is a hash of the bit-packed scene plus options changing the result (diag, channel, ...)
+Two tiers: in-memory LRU, and (optional) on-disk directory with size-based eviction
+Usage:
+    cache= OrgMetricsCache(cache_dir='./cache_org')
+    metrics= com.identify_aggregate_and_get_org_indices(arr,diag=True,cache=cache)
+'''
+
+import numpy as np
+import os
+import hashlib
+from collections import OrderedDict
+
+class OrgMetricsCache:
+    def __init__(self,max_items=100000,cache_dir=None,max_disk_mb=1024):
+        '''
+        max_items: number of scenes kept in memory (least recently used one is dropped first)
+        cache_dir: directory for on-disk tier; no disk tier if None
+        max_disk_mb: size limit of cache_dir; oldest files are removed first
+        '''
+        self.max_items= max_items
+        self.cache_dir= cache_dir
+        self.max_disk= max_disk_mb*2**20
+        self.mem= OrderedDict()
+        self.disk_size= None  ## Total size of cache_dir; scanned at first write
+        self.hits=self.misses= 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir,exist_ok=True)
+
+    @staticmethod
+    def key(amap,domain_size,packed=False,**opts):
+        '''
+        amap: 2d scene [y,x] (or packed by np.packbits along x-axis if packed==True)
+        opts: options changing the result, e.g., diag=True, channel=False
+        '''
+        amap= np.asarray(amap)
+        if not packed:
+            amap= np.packbits(amap.astype(bool,copy=False),axis=-1)
+        hh= hashlib.sha1(np.ascontiguousarray(amap,dtype=np.uint8).tobytes())
+        hh.update(repr((tuple(domain_size),sorted(opts.items()))).encode())
+        return hh.hexdigest()
+
+    def get(self,key):
+        '''
+        Return cached metrics (float array; a copy, so the caller may modify it) or None
+        '''
+        if key in self.mem:
+            self.mem.move_to_end(key)
+            self.hits+=1
+            return self.mem[key].copy()
+
+        if self.cache_dir is not None:
+            fn= self._path(key)
+            try:
+                val= np.load(fn)
+            except (OSError,ValueError):
+                val= None
+            if val is not None:
+                os.utime(fn)  ## Mark as recently used
+                self._put_mem(key,val)
+                self.hits+=1
+                return val.copy()
+        self.misses+=1
+        return None
+
+    def put(self,key,val):
+        val= np.array(val,dtype=float)  ## A copy; not a view into caller's array
+        self._put_mem(key,val)
+        if self.cache_dir is not None:
+            fn= self._path(key)
+            os.makedirs(os.path.dirname(fn),exist_ok=True)
+            tmp= fn+'.{}.tmp'.format(os.getpid())
+            with open(tmp,'wb') as f:
+                np.save(f,val)
+            os.replace(tmp,fn)  ## Atomic, so parallel workers can share cache_dir
+            if self.disk_size is None:
+                self.disk_size= sum(os.path.getsize(f1) for f1,_ in self._disk_files())
+            else:
+                self.disk_size+= os.path.getsize(fn)
+            if self.disk_size>self.max_disk:
+                self._evict_disk()
+        return
+
+    def _put_mem(self,key,val):
+        self.mem[key]= val
+        self.mem.move_to_end(key)
+        while len(self.mem)>self.max_items:
+            self.mem.popitem(last=False)
+        return
+
+    def _path(self,key):
+        return os.path.join(self.cache_dir,key[:2],key+'.npy')
+
+    def _disk_files(self):
+        for sub in os.scandir(self.cache_dir):
+            if sub.is_dir():
+                for f1 in os.scandir(sub.path):
+                    if f1.name.endswith('.npy'):
+                        yield f1.path, f1.stat().st_mtime
+
+    def _evict_disk(self):
+        '''
+        Remove least recently used files until total size is below 90% of the limit
+        '''
+        files= sorted(self._disk_files(),key=lambda x: x[1])
+        self.disk_size= sum(os.path.getsize(f1) for f1,_ in files)
+        for f1,_ in files:
+            if self.disk_size<=self.max_disk*0.9:
+                break
+            try:
+                sz= os.path.getsize(f1)
+                os.remove(f1)
+                self.disk_size-= sz
+            except OSError:
+                pass
+        return
@@ -0,0 +1,130 @@
+'''
+Instrumentation of Org. metrics calculation
+
+Wall time of each phase (labeling, centroid, distance, pair_sums, abcop, iorg, incremental),
+number of aggregates and calculation time of each frame, and throughput
+Nothing is measured unless a stats object is given (stats=None costs only an "is None" check)
+Usage:
+    stats= OrgMetricsStats(callback=print_progress,every=1000)
+    metrics= com.identify_aggregate_and_get_org_indices(arr,diag=True,stats=stats)
+    print(stats.summary())
+'''
+
+import numpy as np
+import time
+
+class OrgMetricsStats:
+    phases= ('labeling','centroid','distance','pair_sums','abcop','iorg','incremental')
+
+    def __init__(self,callback=None,every=1,keep_frames=True):
+        '''
+        callback: function(stats,t,metrics) called after frame t (global index) is done,
+                  every "every" frames; e.g., print_progress
+        keep_frames: if True, (t, number of aggregates, calculation time) of each frame is kept
+                     (see slowest())
+        '''
+        self.callback= callback
+        self.every= max(1,int(every))
+        self.keep_frames= keep_frames
+        self.reset()
+
+    def reset(self):
+        self.phase_time= dict.fromkeys(self.phases,0.)
+        self.n_frames= 0
+        self.n_agg_total= 0
+        self.n_agg_max= 0
+        self.frames= []
+        self.t_start= None
+        self.t_last= None
+        return
+
+    def phase(self,name):
+        '''
+        Context manager adding wall time of the block to phase "name"
+        '''
+        return PhaseTimer(self,name)
+
+    def add(self,name,dt):
+        now= time.perf_counter()
+        if self.t_start is None:
+            self.t_start= now-dt
+        self.t_last= now
+        self.phase_time[name]= self.phase_time.get(name,0.)+dt
+        return
+
+    def frame(self,t,metrics,dt=0.):
+        '''
+        Record a finished frame; metrics: output of calc_org_indexes() (N is metrics[5])
+        dt: calculation time of this frame (labeling is done per chunk, so not included)
+        '''
+        n_agg= int(metrics[5])
+        self.n_frames+= 1
+        self.n_agg_total+= n_agg
+        self.n_agg_max= max(self.n_agg_max,n_agg)
+        self.t_last= time.perf_counter()
+        if self.t_start is None:
+            self.t_start= self.t_last-dt
+        if self.keep_frames:
+            self.frames.append((t,n_agg,dt))
+        if self.callback is not None and (t+1)%self.every==0:
+            self.callback(self,t,metrics)
+        return
+
+    def merge(self,other,metrics,t_offset=0,t_index=None):
+        '''
+        Add stats of a chunk done elsewhere (e.g., in a worker process)
+        metrics: [nt,7] output of the chunk; frames are reported with t_offset
+                 (as t_index[t_offset+t] if t_index is given, e.g., for a subset of frames)
+        '''
+        for name,dt in other.phase_time.items():
+            self.phase_time[name]= self.phase_time.get(name,0.)+dt
+        if self.t_start is None and other.t_start is not None:
+            self.t_start= time.perf_counter()-(other.t_last-other.t_start)
+        dts= {t:dt for t,_,dt in other.frames}
+        for t1 in range(metrics.shape[0]):
+            t= t_offset+t1 if t_index is None else int(t_index[t_offset+t1])
+            self.frame(t,metrics[t1,:],dts.get(t1,0.))
+        return
+
+    def wall_time(self):
+        if self.t_start is None:
+            return 0.
+        return self.t_last-self.t_start
+
+    def slowest(self,k=10):
+        '''
+        k frames of longest calculation time: list of (t, number of aggregates, time)
+        '''
+        return sorted(self.frames,key=lambda x: x[2],reverse=True)[:k]
+
+    def summary(self):
+        wall= self.wall_time()
+        return dict(n_frames=self.n_frames,
+                    n_agg_mean=self.n_agg_total/max(self.n_frames,1),n_agg_max=self.n_agg_max,
+                    wall_time=wall,phase_time=dict(self.phase_time),
+                    frames_per_sec=self.n_frames/wall if wall>0 else np.nan,
+                    aggregates_per_sec=self.n_agg_total/wall if wall>0 else np.nan)
+
+
+class PhaseTimer:
+    __slots__= ('stats','name','t0')
+
+    def __init__(self,stats,name):
+        self.stats= stats
+        self.name= name
+
+    def __enter__(self):
+        self.t0= time.perf_counter()
+        return self
+
+    def __exit__(self,*exc):
+        self.stats.add(self.name,time.perf_counter()-self.t0)
+        return False
+
+
+def print_progress(stats,t,metrics):
+    '''
+    Callback printing frame number and metrics (as the old print_dt output)
+    '''
+    print(t+1,np.round(metrics,3),'{:.1f} frames/s'.format(stats.summary()['frames_per_sec']))
+    return
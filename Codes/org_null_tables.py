@@ -0,0 +1,140 @@
+'''
+Monte Carlo null distribution of Org. metrics under random placement
+
+For a grid size, density, and connectivity options, an ensemble of random scenes
+(uniform, as Case1 of Fig04/Fig09; random_scenes_module.py) is generated and its Org. metrics
+are summarized by quantiles. Tables are kept on disk, keyed by (ny, nx, number of cells, diag, channel),
+so observed metrics can be compared to the null distribution without regenerating scenes.
+Usage:
+    nt= OrgNullTables(cache_dir='./null_tables',nSample=5000,workers=8)
+    oid= com.identify_aggregate_and_get_org_indices(amap,diag=True)
+    pct= nt.percentile(oid,amap.shape,amap.mean(),diag=True)  ## [7]; ~1 (or ~0) is far from random
+    (or n_cells=amap.sum() instead of density; density is converted to the nearest number of cells)
+'''
+
+import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
+import calc_org_metrics_module as com
+import random_scenes_module as rsm
+
+class OrgNullTables:
+    def __init__(self,cache_dir=None,nSample=1000,seed=12321,workers=None,chunk=1000,
+                 quantiles=(0.01,0.05,0.1,0.25,0.5,0.75,0.9,0.95,0.99)):
+        '''
+        cache_dir: directory of tables; tables are kept in memory only if None
+        nSample: number of random scenes per table; a cached table with fewer samples is rebuilt
+        seed: random seed; a table is the same for the same seed regardless of workers and chunk
+        workers: number of processes for Org. metrics of random scenes
+        chunk: number of scenes generated at once
+        quantiles: levels of quantiles in the table
+        '''
+        self.cache_dir= cache_dir
+        self.nSample= nSample
+        self.seed= seed
+        self.workers= workers
+        self.chunk= chunk
+        self.quantiles= np.asarray(quantiles,dtype=float)
+        self.tables= {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir,exist_ok=True)
+
+    @staticmethod
+    def key(domain_size,n_cells,diag=False,channel=False):
+        ny,nx= domain_size
+        return 'ny{}_nx{}_n{}_diag{:d}_ch{:d}'.format(ny,nx,n_cells,diag,channel)
+
+    @staticmethod
+    def cells_of(domain_size,density=None,n_cells=None):
+        '''
+        Number of active cells; density (e.g., amap.mean()) is rounded to the nearest count
+        '''
+        if n_cells is not None:
+            return int(n_cells)
+        if density is None:
+            raise ValueError('Either density or n_cells should be given')
+        ny,nx= domain_size
+        return int(round(ny*nx*density))
+
+    def get(self,domain_size,density=None,diag=False,channel=False,n_cells=None):
+        '''
+        Table (dict) of null distribution; built (and saved) if not found
+            samples: [nSample,7] Org. metrics of random scenes (order of com.metric_names)
+            quantiles: [nq] levels, qvals: [nq,7] quantiles, mean, std: [7]
+        Tables are keyed by number of cells (n_cells, or from density; see cells_of())
+        '''
+        n_cells= self.cells_of(domain_size,density,n_cells)
+        key= self.key(domain_size,n_cells,diag,channel)
+        tab= self.tables.get(key)
+        if tab is None and self.cache_dir is not None:
+            tab= self._load(key)
+        if tab is None or tab['samples'].shape[0]<self.nSample:
+            tab= self.build(domain_size,n_cells=n_cells,diag=diag,channel=channel)
+            if self.cache_dir is not None:
+                self._save(key,tab)
+        self.tables[key]= tab
+        return tab
+
+    def build(self,domain_size,density=None,diag=False,channel=False,n_cells=None):
+        '''
+        Generate nSample random scenes of n_cells (or density) by chunks and summarize their Org. metrics
+        '''
+        n_cells= self.cells_of(domain_size,density,n_cells)
+        n_chunk= -(-self.nSample//self.chunk)
+        seeds= np.random.SeedSequence(self.seed).spawn(n_chunk)  ## Independent stream per chunk
+        samples= np.empty([self.nSample,len(com.metric_names)])
+
+        executor= None
+        if self.workers is not None and self.workers>1:
+            executor= ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            for ic,k0 in enumerate(range(0,self.nSample,self.chunk)):
+                k1= min(k0+self.chunk,self.nSample)
+                arr= rsm.uniform_scenes(k1-k0,domain_size,n_cells,seed=seeds[ic])
+                samples[k0:k1,:]= com.identify_aggregate_and_get_org_indices(arr,diag=diag,channel=channel,
+                                                                             executor=executor).reshape(-1,7)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return self.summarize(samples)
+
+    def summarize(self,samples):
+        return dict(samples=samples,quantiles=self.quantiles,
+                    qvals=np.nanquantile(samples,self.quantiles,axis=0),
+                    mean=np.nanmean(samples,axis=0),std=np.nanstd(samples,axis=0))
+
+    def percentile(self,oid,domain_size,density=None,diag=False,channel=False,n_cells=None):
+        '''
+        Fraction of random scenes below the observed metrics, oid [7] (or [nt,7]); ties count half
+        '''
+        samples= self.get(domain_size,density,diag=diag,channel=channel,n_cells=n_cells)['samples']
+        oid= np.asarray(oid,dtype=float)
+        below= (samples[:,np.newaxis,:]<oid.reshape(1,-1,7)).sum(axis=0)
+        tie= (samples[:,np.newaxis,:]==oid.reshape(1,-1,7)).sum(axis=0)
+        return ((below+tie/2)/samples.shape[0]).reshape(oid.shape)
+
+    def zscore(self,oid,domain_size,density=None,diag=False,channel=False,n_cells=None):
+        '''
+        (oid - mean)/std of the null distribution
+        '''
+        tab= self.get(domain_size,density,diag=diag,channel=channel,n_cells=n_cells)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            return (np.asarray(oid,dtype=float)-tab['mean'])/tab['std']
+
+    def _path(self,key):
+        return os.path.join(self.cache_dir,key+'.npz')
+
+    def _load(self,key):
+        try:
+            with np.load(self._path(key)) as f:
+                return self.summarize(f['samples'])
+        except (OSError,ValueError,KeyError):
+            return None
+
+    def _save(self,key,tab):
+        fn= self._path(key)
+        tmp= fn+'.{}.tmp.npz'.format(os.getpid())
+        np.savez(tmp,samples=tab['samples'],quantiles=tab['quantiles'],qvals=tab['qvals'],
+                 mean=tab['mean'],std=tab['std'])
+        os.replace(tmp,fn)  ## Atomic, so parallel jobs can share cache_dir
+        return
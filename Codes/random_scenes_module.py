@@ -0,0 +1,123 @@
+'''
+Vectorized generator of random scenes (ensembles of [nSample,ny,nx] bool arrays)
+for null-model calibration of Org. metrics
+
+Cases as in Fig04/Fig09 scripts:
+    uniform_scenes: uniform over whole domain
+    region_uniform_scenes: uniform over a sub-region (e.g., corner_region(): two corners)
+    gaussian_scenes: Gaussian clusters
+Every scene has exactly n_cells active cells (no duplicates), and results are reproducible by seed
+Usage:
+    arr= uniform_scenes(10000,(40,40),n_cells_of((40,40),0.05),seed=12321)
+'''
+
+import numpy as np
+import math
+
+def n_cells_of(domain_size,density):
+    '''
+    Number of active cells for target density (as max_cells in Fig04/Fig09)
+    '''
+    ny,nx= domain_size
+    return int(nx*ny*density)
+
+def corner_region(domain_size,frac=0.4):
+    '''
+    Two corner areas (frac of x and y each) used in Fig04 Case2
+    '''
+    ny,nx= domain_size
+    yy,xx= np.meshgrid(np.arange(ny),np.arange(nx),indexing='ij')
+    cond1= np.logical_and(xx<nx*frac,yy<ny*frac)
+    cond2= np.logical_and(xx>=nx*(1-frac),yy>=ny*(1-frac))
+    return np.logical_or(cond1,cond2)
+
+def uniform_scenes(nSample,domain_size,n_cells,seed=None,chunk_mb=64):
+    '''
+    n_cells cells uniformly chosen (without replacement) over the whole domain in each scene
+    seed: int or np.random.Generator
+    '''
+    ny,nx= domain_size
+    return weighted_scenes(nSample,domain_size,n_cells,np.ones(ny*nx),seed=seed,chunk_mb=chunk_mb)
+
+def region_uniform_scenes(nSample,domain_size,n_cells,region,seed=None,chunk_mb=64):
+    '''
+    n_cells cells uniformly chosen over region (bool array [ny,nx]) in each scene
+    '''
+    return weighted_scenes(nSample,domain_size,n_cells,np.asarray(region,dtype=float).reshape(-1),
+                           seed=seed,chunk_mb=chunk_mb)
+
+def gaussian_scenes(nSample,domain_size,n_cells,centers,stds,counts=None,periodic=False,seed=None,chunk_mb=64):
+    '''
+    Cells from Gaussian clusters
+    centers: list of (cy,cx); stds: list of standard deviation (grid cells) of each cluster
+    counts: number of cells of each cluster (sum is n_cells); clusters are filled in order,
+            avoiding cells taken by previous clusters (as Fig04 Case3)
+            If None, all clusters are one mixture with equal weights (as Fig09 Case3)
+    periodic: if True, points out of domain are wrapped (as Fig09 Case2); otherwise discarded
+
+    Drawing rounded Gaussian points until n distinct cells is the same as weighted sampling
+        without replacement by the probability of each cell, which is done at once for all scenes
+    '''
+    weights= [gaussian_cell_prob(domain_size,cyx,std,periodic=periodic) for cyx,std in zip(centers,stds)]
+    if counts is None:
+        return weighted_scenes(nSample,domain_size,n_cells,np.sum(weights,axis=0),seed=seed,chunk_mb=chunk_mb)
+
+    if sum(counts)!=n_cells:
+        raise ValueError('Sum of counts ({}) should be n_cells ({})'.format(sum(counts),n_cells))
+    rg= np.random.default_rng(seed)
+    arr= np.zeros([nSample,]+list(domain_size),dtype=bool)
+    for ww,nc in zip(weights,counts):
+        arr|= weighted_scenes(nSample,domain_size,nc,ww,seed=rg,chunk_mb=chunk_mb,taken=arr)
+    return arr
+
+def gaussian_cell_prob(domain_size,cyx,std,periodic=False):
+    '''
+    Probability of each grid cell [ny*nx] of a rounded 2d Gaussian point, np.rint(std*N(0,1)+c)
+    '''
+    probs=[]
+    for n,c in zip(domain_size,cyx):
+        if periodic:
+            nw= int(math.ceil((abs(c)+6*std)/n))+1  ## Images within 6 std
+            edge= np.arange(-nw*n,(nw+1)*n+1)-0.5
+        else:
+            edge= np.arange(n+1)-0.5
+        cdf= np.array([0.5*(1+math.erf((e-c)/std/math.sqrt(2))) for e in edge])
+        pp= np.diff(cdf)
+        if periodic:
+            pp= pp.reshape(-1,n).sum(axis=0)
+        probs.append(pp)
+    return np.outer(probs[0],probs[1]).reshape(-1)
+
+def weighted_scenes(nSample,domain_size,n_cells,weights,seed=None,chunk_mb=64,taken=None):
+    '''
+    n_cells cells chosen without replacement with probability proportional to weights [ny*nx]
+        (successive sampling; Efraimidis-Spirakis keys, log(u)/w, and top n_cells of them)
+    taken: bool array [nSample,ny,nx] of cells not to be chosen (optional)
+    Scenes are processed by chunks within chunk_mb of memory
+    '''
+    ny,nx= domain_size
+    weights= np.asarray(weights,dtype=float).reshape(-1)
+    rg= np.random.default_rng(seed)
+    arr= np.zeros([nSample,ny,nx],dtype=bool)
+    if n_cells==0:
+        return arr
+    avail= np.count_nonzero(weights>0)
+    if taken is not None:
+        avail= np.logical_and(weights>0,~taken.reshape(nSample,-1)).sum(axis=1).min()
+    if avail<n_cells:
+        raise ValueError('Not enough cells of positive weight for n_cells={}'.format(n_cells))
+
+    ## Cells of zero weight (or taken) get -inf key, so never chosen
+    with np.errstate(divide='ignore'):
+        inv_w= np.where(weights>0,1/weights,np.inf)
+    chunk= max(1,int(chunk_mb*2**20/(ny*nx*8*2)))
+    flat= arr.reshape(nSample,-1)
+    for k0 in range(0,nSample,chunk):
+        k1= min(k0+chunk,nSample)
+        with np.errstate(divide='ignore'):
+            keys= np.log(rg.random((k1-k0,ny*nx)))*inv_w
+        if taken is not None:
+            keys[taken[k0:k1].reshape(k1-k0,-1)]= -np.inf
+        idx= np.argpartition(-keys,n_cells-1,axis=1)[:,:n_cells]
+        flat[np.arange(k0,k1)[:,np.newaxis],idx]= True
+    return arr